@@ -1,14 +1,21 @@
 import os
 import csv
+import hashlib
 import json
+import time
 import logging
 import argparse
 
 import sys
 sys.path.append("../")
 
-from utils import predict_and_evaluate
-from src.model_wrapper import Model_Wrapper
+from utils import predict_and_evaluate, measure_embedding_throughput, resident_memory
+from src.model_wrapper import Model_Wrapper, set_num_threads
+from src.embedding_cache import EmbeddingCache, fingerprint_model, fingerprint_names
+from src.candidate_cache import CandidateCache
+from src.ann_index import IVFPQIndex
+from src.dictionary_index import DictionaryIndex
+from src.token_store import TokenStore
 from src.data_loader import DictionaryDataset, QueryDataset_custom
 
 LOGGER = logging.getLogger()
@@ -27,7 +34,96 @@ def parse_args():
     parser.add_argument('--output_file_path', type=str, default='./output/', help='Directory for output')
     parser.add_argument('--predictions_tsv_file_path', type=str, help="path to save predictions")
 
+    # Tokenizer settings
+    parser.add_argument('--max_length', default=25, type=int)
+    parser.add_argument('--pretokenize_dictionary', action="store_true",
+                        help='tokenize the complete dictionary once and store the token ids next to it')
+
+    # Device
+    parser.add_argument('--device', type=str, help='device to run on, e.g. cpu or cuda (default: cuda if available)')
+    parser.add_argument('--num_threads', type=int, help='number of intra-op threads used on the CPU')
+    parser.add_argument('--num_interop_threads', type=int, help='number of inter-op threads used on the CPU')
+    parser.add_argument('--onnx_path', type=str,
+                        help='run the encoder as an onnxruntime CPU session of this graph (see export_onnx.py)')
+    parser.add_argument('--num_embedding_workers', type=int, default=1,
+                        help='number of CPU processes the dictionaries are embedded with')
+
+    # Metrics
+    parser.add_argument('--metrics_topk', type=int, default=0,
+                        help='number of candidates kept per query for acc@1/5/10 and MRR (default 0: top-1 accuracy only). '
+                             'Queries without a full candidate list, e.g. resolved by exact match, are left out of them')
+
+    # Quantization
+    parser.add_argument('--quantize_int8', action="store_true",
+                        help='run a dynamically int8 quantized encoder on the CPU')
+    parser.add_argument('--quantized_cache_dir', type=str,
+                        help='Directory in which the quantized encoder weights are cached (default: embedding_cache_dir, '
+                             'not cached without either)')
+    parser.add_argument('--benchmark_quantization', action="store_true",
+                        help='also evaluate the float32 encoder on the CPU and report the speedup, memory and accuracy delta')
+
+    # Benchmarking
+    parser.add_argument('--benchmark_embedding', action="store_true",
+                        help='report the dictionary embedding throughput with fixed padding, dynamic padding and prefetching')
+
+    # Exact-match fast path
+    parser.add_argument('--exact_match', action="store_true",
+                        help='resolve queries matching a normalized dictionary name without the encoder')
+    parser.add_argument('--benchmark_exact_match', action="store_true",
+                        help='also run the dense-only path and report the end-to-end speedup of the fast path')
+
+    # Caching
+    parser.add_argument('--embedding_cache_dir', type=str,
+                        help='Directory in which dictionary embeddings are cached across evaluations')
+    parser.add_argument('--mention_cache_size', type=int, default=0,
+                        help='cache the embeddings of up to this many distinct mentions in memory (0 disables the cache)')
+    parser.add_argument('--candidate_cache_dir', type=str,
+                        help='Directory in which the top-k candidates of the exact dense search are cached across evaluations')
+    parser.add_argument('--candidate_topk', type=int, default=10, help='number of cached candidates per query')
+    parser.add_argument('--dictionary_index_dir', type=str,
+                        help='Directory of an incrementally updated index of the complete dictionary: only rows '
+                             'added since the last evaluation are embedded')
+
+    # Compact dictionary embeddings
+    parser.add_argument('--dict_embedding_dtype', default="float32", type=str,
+                        help="{float32|float16|int8} storage and scoring precision of the dictionary embeddings")
+    parser.add_argument('--rescore_topk', type=int,
+                        help='rescore this many compact candidates exactly in float32')
+
+    # Sparse + dense cascade
+    parser.add_argument('--sparse_threshold', type=float,
+                        help='resolve queries whose best TF-IDF character n-gram cosine similarity reaches this value '
+                             'without the encoder, and rerank the sparse shortlist of the others densely')
+    parser.add_argument('--sparse_topk', type=int, default=64, help='size of the sparse shortlist reranked densely')
+
+    # Per-code index
+    parser.add_argument('--code_index_mode', type=str,
+                        help="{centroid|medoid} search one centroid or a few medoids per code instead of every synonym")
+    parser.add_argument('--code_index_medoids', type=int, default=1, help='number of medoids per code')
+    parser.add_argument('--code_index_recheck', type=int,
+                        help='re-check all the synonyms of this many best codes exactly')
+
+    # Approximate nearest neighbour search
+    parser.add_argument('--ann_index_path', type=str,
+                        help='Path of an IVF-PQ index over the complete dictionary (built and saved if it does not exist, '
+                             'or was built from another model or dictionary)')
+    parser.add_argument('--ann_nlist', type=int, default=256, help='number of coarse partitions of a new index')
+    parser.add_argument('--ann_m', type=int, default=16, help='number of PQ sub-vectors of a new index')
+    parser.add_argument('--ann_nprobe', type=int, help='number of partitions visited per query')
+    parser.add_argument('--ann_recall_k', type=int, default=10, help='k of the recall@k against the exact search')
+
     args = parser.parse_args()
+
+    # only one of these replaces the exact dense search, the others would be silently ignored
+    search_modes = [flag for flag, enabled in [
+        ('--candidate_cache_dir', args.candidate_cache_dir is not None),
+        ('--sparse_threshold', args.sparse_threshold is not None),
+        ('--code_index_mode', args.code_index_mode is not None),
+        ('--dict_embedding_dtype', args.dict_embedding_dtype != "float32"),
+        ('--ann_index_path', args.ann_index_path is not None),
+    ] if enabled]
+    if len(search_modes) > 1:
+        parser.error("{} are mutually exclusive".format(", ".join(search_modes)))
     return args
 
 
@@ -41,25 +137,218 @@ def init_logging():
 
 def main(args):
     init_logging()
+    set_num_threads(args.num_threads, args.num_interop_threads)
 
     # load model, dictionary, and data queries
-    model_wrapper = Model_Wrapper().load_model(path=args.model_dir, max_length=25, use_cuda=True)
+    rss_before = resident_memory()
+    model_wrapper = Model_Wrapper().load_model(
+        path=args.model_dir, max_length=args.max_length, use_cuda=True, device=args.device,
+        quantize=args.quantize_int8, quantized_cache_dir=args.quantized_cache_dir or args.embedding_cache_dir,
+        onnx_path=args.onnx_path
+    )
+    encoder_rss = resident_memory() - rss_before
+    model_wrapper.enable_mention_cache(args.mention_cache_size)
     eval_dictionary_complete = DictionaryDataset(dictionary_path=args.complete_dictionary_path).data
     eval_dictionary_only_test_codes = DictionaryDataset(dictionary_path=args.only_test_codes_dictionary_path).data
     eval_queries = QueryDataset_custom(data_dir=args.test_file_path, filter_duplicate=False).data
+    embedding_cache = EmbeddingCache(args.embedding_cache_dir) if args.embedding_cache_dir else None
+    candidate_cache = CandidateCache(args.candidate_cache_dir) if args.candidate_cache_dir else None
+
+    report = {}
+
+    complete_dict_token_store = None
+    if args.pretokenize_dictionary and args.dictionary_index_dir:
+        # the index embeds only the rows it does not hold yet, by name, so a store of the whole file does not apply
+        LOGGER.warning("--pretokenize_dictionary has no effect with --dictionary_index_dir")
+    if args.pretokenize_dictionary and not args.dictionary_index_dir:
+        complete_dict_token_store = TokenStore.load_or_build(
+            args.complete_dictionary_path, model_wrapper.get_dense_tokenizer(), args.max_length,
+            [row[0] for row in eval_dictionary_complete]
+        )
+
+    complete_dict_dense_embeds = None
+    if args.dictionary_index_dir:
+        start = time.time()
+        if os.path.exists(args.dictionary_index_dir):
+            dictionary_index = DictionaryIndex.load(args.dictionary_index_dir)
+        else:
+            dictionary_index = DictionaryIndex(agg_mode='cls')
+        num_embedded = dictionary_index.sync(model_wrapper, eval_dictionary_complete)
+        # the rows in file order, so predictions and subset lookups match a run without the index
+        eval_dictionary_complete, complete_dict_dense_embeds = dictionary_index.dictionary(eval_dictionary_complete)
+        # tombstones of removed rows would otherwise be saved again on every run
+        dictionary_index.compact_if_needed()
+        dictionary_index.save(args.dictionary_index_dir)
+        report['dictionary_index'] = {
+            'num_rows': len(eval_dictionary_complete),
+            'num_embedded': num_embedded,
+            'update_time': time.time() - start,
+        }
+        LOGGER.info(f"Dictionary index: {report['dictionary_index']}")
+
+    ann_index, ann_index_saved = None, False
+    if args.ann_index_path:
+        # an index is only reused for the model and dictionary it was built from
+        ann_fingerprint = hashlib.sha1("{}|{}".format(
+            fingerprint_model(model_wrapper, 'cls'), fingerprint_names([row[0] for row in eval_dictionary_complete])
+        ).encode("utf-8")).hexdigest()
+        if os.path.exists(args.ann_index_path):
+            ann_index = IVFPQIndex.load(args.ann_index_path)
+            if ann_index.fingerprint != ann_fingerprint:
+                LOGGER.info("ANN index {} was built from another model or dictionary, rebuilding it".format(args.ann_index_path))
+                ann_index = None
+            else:
+                ann_index_saved = True
+        if ann_index is None:
+            ann_index = IVFPQIndex(nlist=args.ann_nlist, m=args.ann_m)
+            ann_index.fingerprint = ann_fingerprint
+        if args.ann_nprobe:
+            ann_index.nprobe = args.ann_nprobe
 
     LOGGER.info("Evaluating")
 
+    start = time.time()
     predictions, accuracy, _, _ = predict_and_evaluate(
         model_wrapper=model_wrapper,
         eval_dictionary_complete=eval_dictionary_complete,
         eval_dictionary_only_test_codes=eval_dictionary_only_test_codes,
         eval_queries=eval_queries,
-        agg_mode='cls'
+        agg_mode='cls',
+        embedding_cache=embedding_cache,
+        ann_index=ann_index,
+        ann_recall_k=args.ann_recall_k,
+        dict_embedding_dtype=args.dict_embedding_dtype,
+        rescore_topk=args.rescore_topk,
+        exact_match=args.exact_match,
+        compute_losses=False,
+        embedding_workers=args.num_embedding_workers,
+        model_dir=args.model_dir,
+        complete_dict_dense_embeds=complete_dict_dense_embeds,
+        code_index_mode=args.code_index_mode,
+        code_index_medoids=args.code_index_medoids,
+        code_index_recheck=args.code_index_recheck,
+        sparse_threshold=args.sparse_threshold,
+        sparse_topk=args.sparse_topk,
+        candidate_cache=candidate_cache,
+        candidate_topk=args.candidate_topk,
+        metrics_topk=args.metrics_topk,
+        complete_dict_token_store=complete_dict_token_store,
+        report=report
     )
+    prediction_time = time.time() - start
 
     LOGGER.info(f"Accuracy: {accuracy}")
-    result = {"unofficial_accuracy": accuracy, "predictions": predictions}
+    if 'retrieval_metrics' in report:
+        LOGGER.info(f"Retrieval metrics: {report['retrieval_metrics']}")
+
+    if args.exact_match and args.benchmark_exact_match:
+        start = time.time()
+        _, dense_accuracy, _, _ = predict_and_evaluate(
+            model_wrapper=model_wrapper,
+            eval_dictionary_complete=eval_dictionary_complete,
+            eval_dictionary_only_test_codes=eval_dictionary_only_test_codes,
+            eval_queries=eval_queries,
+            agg_mode='cls',
+            embedding_cache=embedding_cache,
+            compute_losses=False
+        )
+        dense_prediction_time = time.time() - start
+        report['exact_match'].update({
+            'prediction_time': prediction_time,
+            'dense_prediction_time': dense_prediction_time,
+            'speedup': dense_prediction_time / prediction_time,
+            'accuracy_delta': accuracy - dense_accuracy,
+        })
+    if args.exact_match:
+        LOGGER.info(f"Exact match: {report['exact_match']}")
+
+    if args.quantize_int8:
+        # throughput on (up to) the first 10000 dictionary names, enough for a stable estimate on the CPU
+        benchmark_names = [row[0] for row in eval_dictionary_complete[:10000]]
+        report['quantization'] = {
+            'encoder_rss_bytes': encoder_rss,
+            'names_per_sec': measure_embedding_throughput(
+                model_wrapper, benchmark_names, agg_mode='cls', use_cache=False
+            )['names_per_sec'],
+        }
+        if args.benchmark_quantization:
+            rss_before = resident_memory()
+            float_model_wrapper = Model_Wrapper().load_model(
+                path=args.model_dir, max_length=args.max_length, use_cuda=False, device='cpu'
+            )
+            float_encoder_rss = resident_memory() - rss_before
+            _, float_accuracy, _, _ = predict_and_evaluate(
+                model_wrapper=float_model_wrapper,
+                eval_dictionary_complete=eval_dictionary_complete,
+                eval_dictionary_only_test_codes=eval_dictionary_only_test_codes,
+                eval_queries=eval_queries,
+                agg_mode='cls',
+                compute_losses=False
+            )
+            float_names_per_sec = measure_embedding_throughput(
+                float_model_wrapper, benchmark_names, agg_mode='cls'
+            )['names_per_sec']
+            report['quantization'].update({
+                'float32_encoder_rss_bytes': float_encoder_rss,
+                'float32_names_per_sec': float_names_per_sec,
+                'speedup': report['quantization']['names_per_sec'] / float_names_per_sec,
+                'accuracy_float32': float_accuracy,
+                'accuracy_delta': accuracy - float_accuracy,
+            })
+            del float_model_wrapper
+        LOGGER.info(f"Quantization: {report['quantization']}")
+
+    if model_wrapper.mention_cache is not None:
+        report['mention_cache'] = model_wrapper.mention_cache.stats()
+        if args.benchmark_embedding:
+            # the test mentions, in corpus order, as a realistic stream: once without and once with a cold cache
+            query_texts = [eval_query[0] for eval_query in eval_queries]
+            mention_cache = model_wrapper.mention_cache
+            model_wrapper.mention_cache = None
+            uncached = measure_embedding_throughput(model_wrapper, query_texts, agg_mode='cls')
+            stream_cache = model_wrapper.enable_mention_cache(mention_cache.max_size)
+            cached = measure_embedding_throughput(model_wrapper, query_texts, agg_mode='cls')
+            report['mention_cache']['query_stream'] = {
+                'hit_rate': stream_cache.stats()['hit_rate'],
+                'uncached_names_per_sec': uncached['names_per_sec'],
+                'cached_names_per_sec': cached['names_per_sec'],
+                'speedup': cached['names_per_sec'] / uncached['names_per_sec'],
+            }
+            model_wrapper.mention_cache = mention_cache
+        LOGGER.info(f"Mention cache: {report['mention_cache']}")
+
+    if args.benchmark_embedding:
+        complete_dict_names = [row[0] for row in eval_dictionary_complete]
+        configurations = {
+            'max_length': {'padding': 'max_length', 'prefetch_batches': 0},
+            'longest': {'padding': 'longest', 'prefetch_batches': 0},
+            'longest_prefetch': {'padding': 'longest'},
+        }
+        report['embedding_throughput'] = {
+            name: measure_embedding_throughput(model_wrapper, complete_dict_names, agg_mode='cls', use_cache=False, **kwargs)
+            for name, kwargs in configurations.items()
+        }
+        for name in ['longest', 'longest_prefetch']:
+            report['embedding_throughput'][name]['speedup'] = (
+                report['embedding_throughput'][name]['names_per_sec'] /
+                report['embedding_throughput']['max_length']['names_per_sec']
+            )
+        LOGGER.info(f"Embedding throughput: {report['embedding_throughput']}")
+
+    result = {"unofficial_accuracy": accuracy, **report, "predictions": predictions}
+
+    if 'compact' in report:
+        LOGGER.info(f"Compact dictionary embeddings: {report['compact']}")
+    if 'sparse' in report:
+        LOGGER.info(f"Sparse + dense cascade: {report['sparse']}")
+    if 'code_index' in report:
+        report['code_index']['size_reduction'] = report['code_index']['full_num_rows'] / report['code_index']['num_rows']
+        report['code_index']['speedup'] = report['code_index']['full_search_time'] / report['code_index']['search_time']
+        LOGGER.info(f"Code index: {report['code_index']}")
+    if 'ann' in report:
+        LOGGER.info(f"ANN: {report['ann']}")
+    if ann_index is not None and ann_index.is_trained and not ann_index_saved:
+        ann_index.save(args.ann_index_path)
 
     with open(args.output_file_path, 'w') as f:
         json.dump(result, f, indent=4)
@@ -0,0 +1,85 @@
+import sys
+import logging
+import argparse
+import numpy as np
+
+sys.path.append("../")
+
+from src.model_wrapper import Model_Wrapper
+from src.onnx_export import export_onnx
+from src.data_loader import DictionaryDataset
+
+LOGGER = logging.getLogger()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='sapbert onnx export')
+
+    # Paths
+    parser.add_argument('--model_dir', required=True, help='Directory of the checkpoint (as saved by Model_Wrapper.save_model)')
+    parser.add_argument('--output_path', type=str, required=True, help='ONNX file to write')
+
+    # Export settings
+    parser.add_argument('--agg_mode', default="cls", type=str, help="{cls|mean|mean_all_tok} pooling baked into the graph")
+    parser.add_argument('--max_length', default=25, type=int)
+    parser.add_argument('--opset_version', default=14, type=int)
+
+    # Parity check
+    parser.add_argument('--check_parity', action="store_true",
+                        help='compare the onnxruntime embeddings with the PyTorch ones and fail above the tolerance')
+    parser.add_argument('--dictionary_path', type=str, help='dictionary whose names are embedded for the parity check')
+    parser.add_argument('--num_parity_names', default=1000, type=int)
+    parser.add_argument('--parity_atol', default=1e-3, type=float)
+
+    args = parser.parse_args()
+    return args
+
+
+def init_logging():
+    LOGGER.setLevel(logging.INFO)
+    fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%I:%M:%S %p')
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(fmt)
+    LOGGER.addHandler(console)
+
+
+def check_parity(args):
+    """
+    Embed the same names with the PyTorch encoder and the onnxruntime session, and return the
+    largest absolute difference
+    """
+    if args.dictionary_path:
+        names = [row[0] for row in DictionaryDataset(dictionary_path=args.dictionary_path).data[:args.num_parity_names]]
+    else:
+        names = ["dolor torácico", "fiebre", "cefalea tensional", "insuficiencia cardiaca congestiva", "tos"]
+
+    torch_model_wrapper = Model_Wrapper().load_model(
+        path=args.model_dir, max_length=args.max_length, use_cuda=False, device='cpu'
+    )
+    onnx_model_wrapper = Model_Wrapper().load_model(
+        path=args.model_dir, max_length=args.max_length, onnx_path=args.output_path
+    )
+    torch_embeds = torch_model_wrapper.embed_dense(names=names, agg_mode=args.agg_mode)
+    onnx_embeds = onnx_model_wrapper.embed_dense(names=names, agg_mode=args.agg_mode)
+    return float(np.abs(torch_embeds - onnx_embeds).max())
+
+
+def main(args):
+    init_logging()
+
+    model_wrapper = Model_Wrapper().load_model(
+        path=args.model_dir, max_length=args.max_length, use_cuda=False, device='cpu'
+    )
+    export_onnx(model_wrapper, args.output_path, agg_mode=args.agg_mode, opset_version=args.opset_version)
+    LOGGER.info(f"Exported {args.model_dir} to {args.output_path}")
+
+    if args.check_parity:
+        max_abs_diff = check_parity(args)
+        LOGGER.info(f"Parity: max abs diff={max_abs_diff} atol={args.parity_atol}")
+        if max_abs_diff > args.parity_atol:
+            sys.exit(f"ONNX embeddings differ from the PyTorch ones by {max_abs_diff} > {args.parity_atol}")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
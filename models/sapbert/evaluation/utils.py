@@ -1,18 +1,47 @@
+import os
+import time
 import torch
+import shutil
+import resource
+import tempfile
 import numpy as np
 from tqdm import tqdm
+from src.data_loader import get_subset_idxs
+from src.compact_embeddings import CompactEmbeddings, rescore_candidates
+from src.code_index import CodeIndex
+from src.exact_match import ExactMatchIndex
+from src.sparse_index import SparseIndex
+from src.sharded_embedding import embed_dense_sharded
 from pytorch_metric_learning.losses import MultiSimilarityLoss
 from pytorch_metric_learning.miners import MultiSimilarityMiner
 
 
-def calculate_loss_batch(ms_loss, miner, all_embeddings, all_labels, batch_size, desc):
+def gather_rows(query_embeds, dict_embeds, start_idx, end_idx, dict_idxs=None):
+    """
+    Return rows [start_idx, end_idx) of the queries stacked on top of the dictionary, without
+    building the stacked matrix. If dict_idxs is given, the dictionary is restricted to those rows
+    """
+    num_queries = len(query_embeds)
+    parts = []
+    if start_idx < num_queries:
+        parts.append(np.asarray(query_embeds[start_idx:min(end_idx, num_queries)]))
+    dict_start, dict_end = max(start_idx - num_queries, 0), end_idx - num_queries
+    if dict_end > dict_start:
+        if dict_idxs is None:
+            parts.append(np.asarray(dict_embeds[dict_start:dict_end]))
+        else:
+            parts.append(np.asarray(dict_embeds[dict_idxs[dict_start:dict_end]]))
+    return torch.from_numpy(np.concatenate(parts, axis=0))
+
+
+def calculate_loss_batch(ms_loss, miner, query_embeds, dict_embeds, all_labels, batch_size, desc, dict_idxs=None):
     total_loss = 0
-    num_batches = (len(all_embeddings) + batch_size - 1) // batch_size
+    num_batches = (len(all_labels) + batch_size - 1) // batch_size
     for i in tqdm(range(num_batches), total=num_batches, desc=desc):
         start_idx = i * batch_size
-        end_idx = min((i + 1) * batch_size, len(all_embeddings))
+        end_idx = min((i + 1) * batch_size, len(all_labels))
 
-        batch_embeddings = all_embeddings[start_idx:end_idx]
+        batch_embeddings = gather_rows(query_embeds, dict_embeds, start_idx, end_idx, dict_idxs)
         batch_labels = all_labels[start_idx:end_idx]
 
         # Get hard pairs for this batch
@@ -25,24 +54,23 @@ def calculate_loss_batch(ms_loss, miner, all_embeddings, all_labels, batch_size,
     return total_loss / num_batches
 
 
-def calculate_losses(embeds_info, labels_info, batch_size):
+def calculate_losses(embeds_info, labels_info, batch_size, only_test_codes_dict_idxs=None):
+    """
+    If only_test_codes_dict_idxs is given, the only test codes dictionary is read as those rows of
+    the complete dictionary embeddings, and only_test_codes_dict_dense_embeds can be None
+    """
     # deconstruct arguments
     query_embeds, complete_dict_dense_embeds, only_test_codes_dict_dense_embeds = embeds_info
     query_labels, complete_dict_labels, only_test_codes_dict_labels = labels_info
-
-    # obtain query and dict embeddings
-    query_embeddings = torch.from_numpy(query_embeds)
-    dict_embeddings_complete = torch.from_numpy(complete_dict_dense_embeds)
-    dict_embeddings_only_test_codes = torch.from_numpy(only_test_codes_dict_dense_embeds)
+    if only_test_codes_dict_idxs is not None:
+        only_test_codes_dict_dense_embeds = complete_dict_dense_embeds
 
     # obtain query and dict labels
     query_labels = torch.tensor([hash(label) for label in query_labels])
     dict_labels_complete = torch.tensor([hash(row[1]) for row in complete_dict_labels])
     dict_labels_only_test_codes = torch.tensor([hash(row[1]) for row in only_test_codes_dict_labels])
 
-    # join query and dict embeddings and labels
-    all_embeddings_complete = torch.cat([query_embeddings, dict_embeddings_complete], dim=0)
-    all_embeddings_only_test_codes = torch.cat([query_embeddings, dict_embeddings_only_test_codes], dim=0)
+    # join query and dict labels (the embeddings are joined batch by batch)
     all_labels_complete = torch.cat([query_labels, dict_labels_complete])
     all_labels_only_test_codes = torch.cat([query_labels, dict_labels_only_test_codes])
 
@@ -51,8 +79,14 @@ def calculate_losses(embeds_info, labels_info, batch_size):
     miner = MultiSimilarityMiner()
 
     # calculate loss by batches
-    validation_loss_complete = calculate_loss_batch(ms_loss, miner, all_embeddings_complete, all_labels_complete, batch_size, "- Calculating Val Loss 1")
-    validation_loss_only_test_codes = calculate_loss_batch(ms_loss, miner, all_embeddings_only_test_codes, all_labels_only_test_codes, batch_size, "- Calculating Val Loss 2")
+    validation_loss_complete = calculate_loss_batch(
+        ms_loss, miner, query_embeds, complete_dict_dense_embeds, all_labels_complete, batch_size,
+        "- Calculating Val Loss 1"
+    )
+    validation_loss_only_test_codes = calculate_loss_batch(
+        ms_loss, miner, query_embeds, only_test_codes_dict_dense_embeds, all_labels_only_test_codes, batch_size,
+        "- Calculating Val Loss 2", dict_idxs=only_test_codes_dict_idxs
+    )
 
     return validation_loss_complete, validation_loss_only_test_codes
 
@@ -66,67 +100,540 @@ def check_label(predicted_cui, golden_cui):
     return int(len(set(predicted_cui.split("|")).intersection(set(golden_cui.split("|")))) > 0)
 
 
-def predict_and_evaluate(model_wrapper, eval_dictionary_complete, eval_dictionary_only_test_codes, eval_queries, agg_mode="cls", batch_size=1024):
-    complete_dict_names = [row[0] for row in eval_dictionary_complete]
-    only_test_codes_dict_names = [row[0] for row in eval_dictionary_only_test_codes]
-    complete_dict_dense_embeds = model_wrapper.embed_dense(
-        names=complete_dict_names, show_progress=True, agg_mode=agg_mode, description="- Embedding Dictionary 1"
+def check_labels(predicted_cuis, golden_cuis):
+    """
+    Vectorized version of check_label over aligned sequences of predicted and golden cuis.
+    Plain cuis are compared at once, and only composite ones fall back to check_label
+    """
+    predicted_cuis = np.asarray(predicted_cuis, dtype=object)
+    golden_cuis = np.asarray(golden_cuis, dtype=object)
+    correct = (predicted_cuis == golden_cuis).astype(int)
+    is_composite = np.array(['|' in p or '|' in g for p, g in zip(predicted_cuis, golden_cuis)], dtype=bool)
+    for i in np.flatnonzero(is_composite):
+        correct[i] = check_label(predicted_cuis[i], golden_cuis[i])
+    return correct
+
+
+def top1_accuracy(eval_dictionary, candidate_idxs, query_labels):
+    """
+    Accuracy of the top candidate of every query
+    """
+    return float(check_labels([eval_dictionary[i][1] for i in candidate_idxs[:, 0]], query_labels).mean())
+
+
+def retrieval_metrics(eval_dictionary, candidate_idxs, query_labels, cutoffs=(1, 5, 10)):
+    """
+    acc@k for every cutoff k and MRR, computed at once from a matrix of sorted candidate idxes.
+    A candidate counts as correct as in check_label (composite cuis match if any cui is shared),
+    and padded candidates (-1) never do
+
+    Parameters
+    ----------
+    eval_dictionary : list
+        (name, cui) rows indexed by the candidate idxes
+    candidate_idxs : np.array
+        2d numpy array of dictionary idxes [# of query, topk]
+    query_labels : list
+        The golden cui of every query
+
+    Returns
+    -------
+    metrics : dict
+        acc@k for every cutoff k <= topk, and mrr@topk
+    """
+    num_queries, topk = candidate_idxs.shape
+    dict_labels = np.asarray([row[1] for row in eval_dictionary], dtype=object)
+    candidate_labels = dict_labels[np.maximum(candidate_idxs, 0)]
+    hits = check_labels(candidate_labels.ravel(), np.repeat(np.asarray(query_labels, dtype=object), topk))
+    hits = hits.reshape(num_queries, topk).astype(bool) & (candidate_idxs >= 0)
+
+    # rank of the first correct candidate, topk if there is none
+    first_hit = np.where(hits.any(1), hits.argmax(1), topk)
+    metrics = {f'acc@{k}': float((first_hit < k).mean()) for k in cutoffs if k <= topk}
+    metrics[f'mrr@{topk}'] = float(np.where(first_hit < topk, 1 / (first_hit + 1), 0).mean())
+    return metrics
+
+
+def recall_at_k(approx_idxs, exact_idxs):
+    """
+    Mean fraction of the exact topk candidates that an approximate search also retrieved
+    """
+    k = exact_idxs.shape[1]
+    hits = [len(set(approx[:k].tolist()) & set(exact.tolist())) for approx, exact in zip(approx_idxs, exact_idxs)]
+    return sum(hits) / (k * len(hits))
+
+
+def measure_embedding_throughput(model_wrapper, names, agg_mode="cls", **embed_kwargs):
+    """
+    Embed names once and return the throughput, in names per second
+    """
+    start = time.time()
+    model_wrapper.embed_dense(names=names, agg_mode=agg_mode, **embed_kwargs)
+    seconds = time.time() - start
+    return {'seconds': seconds, 'names_per_sec': len(names) / seconds}
+
+
+def resident_memory():
+    """
+    Current resident set size of this process in bytes (peak resident set size where /proc is unavailable)
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def embed_dictionary(model_wrapper, names, agg_mode, description, embedding_cache=None, model_key=None,
+                     num_workers=1, model_dir=None, token_store=None):
+    if embedding_cache is not None:
+        return embedding_cache.embed_dense(
+            model_wrapper, names, agg_mode=agg_mode, model_key=model_key, description=description,
+            num_workers=num_workers, model_dir=model_dir, token_store=token_store
+        )
+    if num_workers > 1:
+        # the mapping stays valid after the file is unlinked
+        output_path = os.path.join(tempfile.mkdtemp(), "dict_embeds.npy")
+        dense_embeds = embed_dense_sharded(
+            model_wrapper, names, output_path, num_workers, model_dir=model_dir, agg_mode=agg_mode,
+            token_store=token_store
+        )
+        shutil.rmtree(os.path.dirname(output_path))
+        return dense_embeds
+    return model_wrapper.embed_dense(
+        names=names, show_progress=True, agg_mode=agg_mode, description=description, token_store=token_store,
+        use_cache=False
+    )
+
+
+def rerank_shortlist(model_wrapper, query_embeds, shortlist, dict_names, agg_mode, dict_embeds=None, topk=1):
+    """
+    Return the dictionary idxes of the topk shortlisted names of every query, scoring only the
+    shortlisted names densely (they are embedded on the fly unless dict_embeds is given)
+    """
+    # pad the shortlists with their first candidate (and empty shortlists with the first name)
+    shortlist = np.where(shortlist >= 0, shortlist, shortlist[:, :1])
+    shortlist[shortlist < 0] = 0
+    if dict_embeds is None:
+        rows = np.unique(shortlist)
+        dict_embeds = model_wrapper.embed_dense(
+            names=[dict_names[row] for row in rows], show_progress=True, agg_mode=agg_mode,
+            description="- Embedding Shortlist", use_cache=False
+        )
+        _, local_idxs = rescore_candidates(query_embeds, dict_embeds, np.searchsorted(rows, shortlist), topk=topk)
+        return rows[local_idxs]
+    _, idxs = rescore_candidates(query_embeds, dict_embeds, shortlist, topk=topk)
+    return idxs
+
+
+def search_code_index(model_wrapper, query_embeds, query_labels, eval_dictionary, dict_embeds, code_index_mode,
+                      code_index_medoids=1, code_index_recheck=None, topk=1, report=None):
+    """
+    Search per-code centroids or medoids, optionally re-checking the synonyms of the best codes
+    """
+    build_start = time.time()
+    code_index = CodeIndex(
+        dict_embeds, [row[1] for row in eval_dictionary], mode=code_index_mode, num_medoids=code_index_medoids
     )
-    only_test_codes_dict_dense_embeds = model_wrapper.embed_dense(
-        names=only_test_codes_dict_names, show_progress=True, agg_mode=agg_mode, description="- Embedding Dictionary 2"
+    build_time = time.time() - build_start
+    search_start = time.time()
+    _, candidate_idxs = code_index.search(
+        model_wrapper, query_embeds, topk=topk, dict_embeds=dict_embeds, recheck_codes=code_index_recheck
     )
+    code_search_time = time.time() - search_start
 
-    mean_centering = False
-    if mean_centering:
-        complete_tgt_space_mean_vec = complete_dict_dense_embeds.mean(0)
-        complete_dict_dense_embeds -= complete_tgt_space_mean_vec
-        only_test_codes_tgt_space_mean_vec = only_test_codes_dict_dense_embeds.mean(0)
-        only_test_codes_dict_dense_embeds -= only_test_codes_tgt_space_mean_vec
+    if report is not None:
+        search_start = time.time()
+        _, exact_candidate_idxs = model_wrapper.retrieve_candidate_blocked(
+            query_embeds=query_embeds,
+            dict_embeds=dict_embeds,
+            topk=1,
+        )
+        full_search_time = time.time() - search_start
+        code_accuracy = top1_accuracy(eval_dictionary, candidate_idxs, query_labels)
+        full_accuracy = top1_accuracy(eval_dictionary, exact_candidate_idxs, query_labels)
+        report['code_index'] = {
+            'mode': code_index_mode,
+            'num_medoids': code_index_medoids if code_index_mode == 'medoid' else None,
+            'recheck_codes': code_index_recheck,
+            'num_rows': len(code_index),
+            'full_num_rows': len(dict_embeds),
+            'index_bytes': int(code_index.nbytes),
+            'full_bytes': int(np.dtype(np.float32).itemsize * np.prod(dict_embeds.shape)),
+            'build_time': build_time,
+            'search_time': code_search_time,
+            'full_search_time': full_search_time,
+            'accuracy_full': full_accuracy,
+            'accuracy_delta': code_accuracy - full_accuracy,
+        }
+    return candidate_idxs
 
-    predictions = []
-    query_embeds = []
-    query_labels = []
-    for eval_query in tqdm(eval_queries, total=len(eval_queries), desc="- Obtaining Predictions"):
-        text = eval_query[0]
-        golden_cui = eval_query[1]
 
-        text_dense_embeds = model_wrapper.embed_dense(names=[text], agg_mode=agg_mode)
+def search_compact(model_wrapper, query_embeds, query_labels, eval_dictionary, dict_embeds, dict_embedding_dtype,
+                   rescore_topk=None, topk=1, report=None):
+    """
+    Score against int8/float16 dictionary embeddings, optionally rescoring the best ones in float32
+    """
+    rss_before = resident_memory()
+    compact_dict_embeds = CompactEmbeddings(dict_embeds, dtype=dict_embedding_dtype)
+    search_start = time.time()
+    _, candidate_idxs = compact_dict_embeds.search(
+        model_wrapper, query_embeds, topk=topk, dict_embeds=dict_embeds, rescore_topk=rescore_topk
+    )
+    compact_search_time = time.time() - search_start
+    compact_rss = resident_memory() - rss_before
 
-        if mean_centering:
-            text_dense_embeds -= complete_tgt_space_mean_vec
+    if report is not None:
+        search_start = time.time()
+        _, exact_candidate_idxs = model_wrapper.retrieve_candidate_blocked(
+            query_embeds=query_embeds,
+            dict_embeds=dict_embeds,
+            topk=1,
+        )
+        exact_search_time = time.time() - search_start
+        compact_accuracy = top1_accuracy(eval_dictionary, candidate_idxs, query_labels)
+        exact_accuracy = top1_accuracy(eval_dictionary, exact_candidate_idxs, query_labels)
+        report['compact'] = {
+            'dtype': dict_embedding_dtype,
+            'rescore_topk': rescore_topk,
+            # the float32 embeddings stay resident next to the compact ones (for the caller and the
+            # exact comparison), so these are the matrix sizes, and the measured resident set size
+            # shows what the compact search actually added
+            'float32_bytes': int(np.dtype(np.float32).itemsize * np.prod(dict_embeds.shape)),
+            'compact_bytes': int(compact_dict_embeds.nbytes),
+            'compact_rss_delta_bytes': int(compact_rss),
+            'resident_bytes': int(resident_memory()),
+            'accuracy_float32': exact_accuracy,
+            'accuracy_delta': compact_accuracy - exact_accuracy,
+            'compact_search_time': compact_search_time,
+            'exact_search_time': exact_search_time,
+        }
+    return candidate_idxs
+
+
+def search_ann(model_wrapper, query_embeds, dict_embeds, ann_index, ann_recall_k=10, report=None):
+    """
+    Search with an IVF-PQ index (built on first use), comparing against the exact search if a
+    report is requested
+    """
+    if not ann_index.is_trained:
+        ann_index.build(dict_embeds)
+    search_start = time.time()
+    _, candidate_idxs = ann_index.search(query_embeds, topk=ann_recall_k)
+    ann_search_time = time.time() - search_start
 
-        query_embeds.append(text_dense_embeds[0])
-        query_labels.append(golden_cui)
+    # compare against the exact search, to pick the speed/accuracy trade-off
+    if report is not None:
+        search_start = time.time()
+        _, exact_candidate_idxs = model_wrapper.retrieve_candidate_blocked(
+            query_embeds=query_embeds,
+            dict_embeds=dict_embeds,
+            topk=ann_recall_k,
+        )
+        report['ann'] = {
+            'nlist': ann_index.nlist,
+            'm': ann_index.m,
+            'nprobe': ann_index.nprobe,
+            f'recall@{ann_recall_k}': recall_at_k(candidate_idxs, exact_candidate_idxs),
+            'recall@1': recall_at_k(candidate_idxs[:, :1], exact_candidate_idxs[:, :1]),
+            'ann_search_time': ann_search_time,
+            'exact_search_time': time.time() - search_start,
+        }
 
-        # get score matrix
-        dense_score_matrix = model_wrapper.get_score_matrix(
-            query_embeds=text_dense_embeds,
-            dict_embeds=complete_dict_dense_embeds,
+    # the probed partitions of some queries can hold fewer than ann_recall_k rows, and their -1
+    # padding would index the last dictionary row, so those queries are searched exactly
+    short = (candidate_idxs < 0).any(1)
+    if short.any():
+        _, candidate_idxs[short] = model_wrapper.retrieve_candidate_blocked(
+            query_embeds=query_embeds[short],
+            dict_embeds=dict_embeds,
+            topk=ann_recall_k,
         )
-        score_matrix = dense_score_matrix
+    if report is not None:
+        report['ann']['backfilled_fraction'] = float(short.mean())
+    return candidate_idxs
 
-        candidate_id = model_wrapper.retrieve_candidate_cuda(score_matrix=score_matrix, topk=1, batch_size=16)[0].tolist()[0]
-        np_candidate = eval_dictionary_complete[candidate_id]
 
+def search_dictionary(model_wrapper, query_embeds, query_labels, eval_dictionary, dict_embeds, ann_index=None,
+                      ann_recall_k=10, dict_embedding_dtype="float32", rescore_topk=None, code_index_mode=None,
+                      code_index_medoids=1, code_index_recheck=None, topk=1, report=None):
+    """
+    Return the candidate dictionary idxes of every query (the first column is the prediction),
+    searching exactly, per code, with an ANN index, or against compact dictionary embeddings.
+    Every mode returns topk candidates, except the ANN search, which returns ann_recall_k
+    """
+    if code_index_mode is not None:
+        return search_code_index(
+            model_wrapper, query_embeds, query_labels, eval_dictionary, dict_embeds, code_index_mode,
+            code_index_medoids, code_index_recheck, topk, report
+        )
+    if dict_embedding_dtype != "float32":
+        return search_compact(
+            model_wrapper, query_embeds, query_labels, eval_dictionary, dict_embeds, dict_embedding_dtype,
+            rescore_topk, topk, report
+        )
+    if ann_index is not None:
+        return search_ann(model_wrapper, query_embeds, dict_embeds, ann_index, ann_recall_k, report)
+
+    # one blocked top-k search for all the queries
+    _, candidate_idxs = model_wrapper.retrieve_candidate_blocked(
+        query_embeds=query_embeds,
+        dict_embeds=dict_embeds,
+        topk=topk,
+        show_progress=True,
+    )
+    return candidate_idxs
+
+
+def set_candidates(candidate_idxs, rows, new_candidate_idxs):
+    """
+    Write the sorted candidates of some queries into the candidate matrix, as far as both widths allow
+    """
+    width = min(candidate_idxs.shape[1], new_candidate_idxs.shape[1])
+    candidate_idxs[rows, :width] = new_candidate_idxs[:, :width]
+
+
+def resolve_exact_matches(dict_names, query_texts, candidate_idxs, report=None):
+    """
+    Resolve the queries that match a dictionary name (after normalization) without the encoder,
+    writing the matched dictionary idx as their prediction
+    """
+    candidate_idxs[:, 0] = ExactMatchIndex(dict_names).lookup(query_texts)
+    if report is not None:
+        report['exact_match'] = {'resolved_fraction': float((candidate_idxs[:, 0] >= 0).mean())}
+
+
+def load_cached_candidates(model_wrapper, candidate_cache, dict_names, query_texts, agg_mode, candidate_topk,
+                           report=None):
+    """
+    Look up the candidates of the exact dense search of query_texts in the candidate cache
+
+    Returns
+    -------
+    cached_candidates : tuple
+        The cached (topk_scores, topk_idxs), or None on a miss
+    candidate_path : str
+        The file where the candidates of these queries are stored
+    """
+    candidate_path = candidate_cache.path(
+        candidate_cache.model_key(model_wrapper, agg_mode), dict_names, query_texts, candidate_topk
+    )
+    cached_candidates = candidate_cache.load(candidate_path)
+    if report is not None:
+        report['candidate_cache'] = {'path': candidate_path, 'hit': cached_candidates is not None}
+    return cached_candidates, candidate_path
+
+
+def cache_candidates(model_wrapper, candidate_cache, candidate_path, query_embeds, dict_embeds, candidate_topk):
+    """
+    Run the exact dense search of the queries and store its candidates in the candidate cache
+    """
+    cached_candidates = model_wrapper.retrieve_candidate_blocked(
+        query_embeds=query_embeds,
+        dict_embeds=dict_embeds,
+        topk=candidate_topk,
+        show_progress=True,
+    )
+    candidate_cache.save(candidate_path, *cached_candidates)
+    return cached_candidates
+
+
+def sparse_cascade(dict_names, query_texts, candidate_idxs, dense_mask, sparse_threshold, sparse_topk=64,
+                   report=None):
+    """
+    Resolve the queries of dense_mask whose best TF-IDF character n-gram match is confident enough,
+    writing their sparse candidates into candidate_idxs, and return the sparse shortlists of the
+    others (in query order) for the dense stage
+    """
+    stage_start = time.time()
+    sparse_index = SparseIndex(dict_names)
+    sparse_build_time = time.time() - stage_start
+    stage_start = time.time()
+    dense_idxs = np.flatnonzero(dense_mask)
+    sparse_scores, shortlist = sparse_index.search(
+        [query_texts[i] for i in dense_idxs], topk=sparse_topk, show_progress=True
+    )
+    confident = (sparse_scores[:, 0] >= sparse_threshold) & (shortlist[:, 0] >= 0)
+    set_candidates(candidate_idxs, dense_idxs[confident], shortlist[confident])
+    if report is not None:
+        report['sparse'] = {
+            'threshold': sparse_threshold,
+            'shortlist_size': sparse_topk,
+            'resolved_fraction': float(confident.sum() / len(query_texts)),
+            'build_time': sparse_build_time,
+            'search_time': time.time() - stage_start,
+        }
+    return shortlist[~confident]
+
+
+def embed_eval_dictionaries(model_wrapper, eval_dictionary_complete, eval_dictionary_only_test_codes, agg_mode,
+                            embedding_cache=None, embedding_workers=1, model_dir=None,
+                            complete_dict_dense_embeds=None, complete_dict_token_store=None, compute_losses=True):
+    """
+    Embed the complete dictionary (unless its embeddings are given), and the only test codes one if
+    the validation losses need it and it is not a subset of the complete one
+
+    Returns
+    -------
+    complete_dict_dense_embeds : np.array
+    only_test_codes_dict_dense_embeds : np.array
+        None if not embedded
+    only_test_codes_dict_idxs : np.array
+        The rows of the complete dictionary that make up the only test codes one, or None
+    """
+    complete_dict_names = [row[0] for row in eval_dictionary_complete]
+    only_test_codes_dict_names = [row[0] for row in eval_dictionary_only_test_codes]
+    model_key = embedding_cache.model_key(model_wrapper, agg_mode) if embedding_cache is not None else None
+    if complete_dict_dense_embeds is None:
+        complete_dict_dense_embeds = embed_dictionary(
+            model_wrapper, complete_dict_names, agg_mode, "- Embedding Dictionary 1", embedding_cache, model_key,
+            embedding_workers, model_dir, complete_dict_token_store
+        )
+
+    # the only test codes dictionary is (by construction) a subset of the complete one, so it is
+    # read as rows of the complete dictionary embeddings instead of being embedded again
+    only_test_codes_dict_idxs = get_subset_idxs(complete_dict_names, only_test_codes_dict_names)
+    if only_test_codes_dict_idxs is None and compute_losses:
+        only_test_codes_dict_dense_embeds = embed_dictionary(
+            model_wrapper, only_test_codes_dict_names, agg_mode, "- Embedding Dictionary 2", embedding_cache, model_key,
+            embedding_workers, model_dir
+        )
+    else:
+        only_test_codes_dict_dense_embeds = None
+    return complete_dict_dense_embeds, only_test_codes_dict_dense_embeds, only_test_codes_dict_idxs
+
+
+def evaluate_candidates(eval_dictionary, query_texts, query_labels, candidate_idxs, metrics_topk=None, report=None):
+    """
+    Return the predictions (the first candidate of every query) and their accuracy, and add the
+    top-k retrieval metrics to the report if metrics_topk is set
+    """
+    assert (candidate_idxs[:, 0] >= 0).all(), "every query needs a prediction"
+    np_candidates = [eval_dictionary[candidate_id] for candidate_id in candidate_idxs[:, 0]]
+    correct = check_labels([np_candidate[1] for np_candidate in np_candidates], query_labels)
+
+    predictions = []
+    for text, golden_cui, np_candidate, is_correct in zip(query_texts, query_labels, np_candidates, correct):
         predictions.append({
             'text': text,
             'golden_cui': golden_cui,
             'candidate_name': np_candidate[0],
             'candidate_label': np_candidate[1],
-            'correct': check_label(np_candidate[1], golden_cui)
+            'correct': int(is_correct)
         })
 
     accuracy = sum(item["correct"] for item in predictions) / len(predictions)
+    if metrics_topk and report is not None:
+        # queries resolved by exact match (or searched with fewer candidates) have no full top-k list,
+        # and counting their padding as misses would understate every metric
+        full = (candidate_idxs >= 0).all(1)
+        report['retrieval_metrics'] = {'num_queries': int(full.sum()), 'num_skipped': int((~full).sum())}
+        if full.any():
+            report['retrieval_metrics'].update(retrieval_metrics(
+                eval_dictionary, candidate_idxs[full], [label for label, f in zip(query_labels, full) if f]
+            ))
+    return predictions, accuracy
+
+
+def predict_and_evaluate(model_wrapper, eval_dictionary_complete, eval_dictionary_only_test_codes, eval_queries, agg_mode="cls", batch_size=1024, embedding_cache=None, ann_index=None, ann_recall_k=10, dict_embedding_dtype="float32", rescore_topk=None, exact_match=False, compute_losses=True, embedding_workers=1, model_dir=None, complete_dict_dense_embeds=None, code_index_mode=None, code_index_medoids=1, code_index_recheck=None, sparse_threshold=None, sparse_topk=64, candidate_cache=None, candidate_topk=10, metrics_topk=None, complete_dict_token_store=None, report=None):
+    complete_dict_names = [row[0] for row in eval_dictionary_complete]
+    query_texts = [eval_query[0] for eval_query in eval_queries]
+    query_labels = [eval_query[1] for eval_query in eval_queries]
+
+    # sorted candidates of every query (the first column is the prediction), padded with -1
+    topk = metrics_topk or 1
+    candidate_idxs = np.full((len(query_texts), topk), -1, dtype=np.int64)
+    if exact_match:
+        resolve_exact_matches(complete_dict_names, query_texts, candidate_idxs, report)
+    dense_mask = candidate_idxs[:, 0] < 0
 
-    query_embeds = np.vstack(query_embeds)
-    complete_dict_labels = [row[1] for row in eval_dictionary_complete]
-    only_test_codes_dict_labels = [row[1] for row in eval_dictionary_only_test_codes]
-    validation_loss_complete, validation_loss_only_test_codes = calculate_losses(
-        (query_embeds, complete_dict_dense_embeds, only_test_codes_dict_dense_embeds),
-        (query_labels, complete_dict_labels, only_test_codes_dict_labels),
-        batch_size
+    # the candidate cache stores (and serves) the top-k candidates of the exact dense search
+    cached_candidates, candidate_path = None, None
+    if candidate_cache is not None and dense_mask.any():
+        if metrics_topk and candidate_topk < metrics_topk:
+            raise ValueError("the candidate cache stores {} candidates per query, fewer than metrics_topk={}".format(
+                candidate_topk, metrics_topk
+            ))
+        if ann_index is not None or dict_embedding_dtype != "float32" or code_index_mode is not None or sparse_threshold is not None:
+            raise ValueError("the candidate cache only stores the candidates of the exact dense search")
+        cached_candidates, candidate_path = load_cached_candidates(
+            model_wrapper, candidate_cache, complete_dict_names, [query_texts[i] for i in np.flatnonzero(dense_mask)],
+            agg_mode, candidate_topk, report
+        )
+
+    # cascade: shortlist the sparse candidates of the queries it does not resolve for the dense stage
+    shortlist = None
+    if sparse_threshold is not None and dense_mask.any():
+        shortlist = sparse_cascade(
+            complete_dict_names, query_texts, candidate_idxs, dense_mask, sparse_threshold, sparse_topk, report
+        )
+        dense_mask = candidate_idxs[:, 0] < 0
+    dense_start = time.time()
+
+    mean_centering = False
+    dense_search = dense_mask.any() and cached_candidates is None
+    only_test_codes_dict_dense_embeds, only_test_codes_dict_idxs = None, None
+    if compute_losses or (dense_search and shortlist is None):
+        complete_dict_dense_embeds, only_test_codes_dict_dense_embeds, only_test_codes_dict_idxs = embed_eval_dictionaries(
+            model_wrapper, eval_dictionary_complete, eval_dictionary_only_test_codes, agg_mode, embedding_cache,
+            embedding_workers, model_dir, complete_dict_dense_embeds, complete_dict_token_store, compute_losses
+        )
+
+        if mean_centering:
+            complete_tgt_space_mean_vec = complete_dict_dense_embeds.mean(0)
+            complete_dict_dense_embeds -= complete_tgt_space_mean_vec
+            if only_test_codes_dict_dense_embeds is not None:
+                only_test_codes_tgt_space_mean_vec = only_test_codes_dict_dense_embeds.mean(0)
+                only_test_codes_dict_dense_embeds -= only_test_codes_tgt_space_mean_vec
+
+    if dense_search or compute_losses:
+        # embed the queries at once, in batches (the validation losses need all of them)
+        embed_mask = np.ones(len(query_texts), dtype=bool) if compute_losses else dense_mask
+        query_embeds = model_wrapper.embed_dense(
+            names=[text for text, embed in zip(query_texts, embed_mask) if embed],
+            show_progress=True, agg_mode=agg_mode, description="- Embedding Queries"
+        )
+
+        if mean_centering:
+            query_embeds -= complete_tgt_space_mean_vec
+
+    if dense_mask.any() and candidate_cache is not None:
+        if cached_candidates is None:
+            cached_candidates = cache_candidates(
+                model_wrapper, candidate_cache, candidate_path, query_embeds[dense_mask[embed_mask]],
+                complete_dict_dense_embeds, candidate_topk
+            )
+        set_candidates(candidate_idxs, dense_mask, cached_candidates[1])
+    elif dense_mask.any() and shortlist is not None:
+        set_candidates(candidate_idxs, dense_mask, rerank_shortlist(
+            model_wrapper, query_embeds[dense_mask[embed_mask]], shortlist, complete_dict_names, agg_mode,
+            complete_dict_dense_embeds, topk=min(topk, shortlist.shape[1])
+        ))
+    elif dense_mask.any():
+        set_candidates(candidate_idxs, dense_mask, search_dictionary(
+            model_wrapper, query_embeds[dense_mask[embed_mask]], [query_labels[i] for i in np.flatnonzero(dense_mask)],
+            eval_dictionary_complete, complete_dict_dense_embeds, ann_index, ann_recall_k, dict_embedding_dtype,
+            rescore_topk, code_index_mode, code_index_medoids, code_index_recheck, topk, report
+        ))
+    if report is not None and 'sparse' in report:
+        report['sparse']['dense_time'] = time.time() - dense_start
+
+    predictions, accuracy = evaluate_candidates(
+        eval_dictionary_complete, query_texts, query_labels, candidate_idxs, metrics_topk, report
     )
 
-    torch.cuda.empty_cache()
+    validation_loss_complete, validation_loss_only_test_codes = None, None
+    if compute_losses:
+        complete_dict_labels = [row[1] for row in eval_dictionary_complete]
+        only_test_codes_dict_labels = [row[1] for row in eval_dictionary_only_test_codes]
+        validation_loss_complete, validation_loss_only_test_codes = calculate_losses(
+            (query_embeds, complete_dict_dense_embeds, only_test_codes_dict_dense_embeds),
+            (query_labels, complete_dict_labels, only_test_codes_dict_labels),
+            batch_size,
+            only_test_codes_dict_idxs=only_test_codes_dict_idxs
+        )
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
     return predictions, accuracy, validation_loss_complete, validation_loss_only_test_codes
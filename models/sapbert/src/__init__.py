@@ -5,8 +5,22 @@ from .data_loader import (
     QueryDataset_pretraining, 
     MetricLearningDataset,
     MetricLearningDataset_pairwise,
+    MetricLearningDataset_grouped,
     DictionaryDataset,
 )
 
 from .metric_learning import Sap_Metric_Learning
 from .model_wrapper import Model_Wrapper
+from .embedding_cache import EmbeddingCache
+from .ann_index import IVFPQIndex
+from .compact_embeddings import CompactEmbeddings
+from .exact_match import ExactMatchIndex
+from .sharded_embedding import embed_dense_sharded
+from .dictionary_index import DictionaryIndex
+from .code_index import CodeIndex
+from .sparse_index import SparseIndex
+from .candidate_cache import CandidateCache
+from .onnx_export import export_onnx
+from .mention_cache import MentionCache
+from .token_store import TokenStore
+from .model_snapshot import ModelSnapshot
@@ -0,0 +1,224 @@
+import logging
+import numpy as np
+from tqdm import tqdm
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _squared_distances(x, centroids):
+    return (x ** 2).sum(1)[:, np.newaxis] - 2 * np.matmul(x, centroids.T) + (centroids ** 2).sum(1)[np.newaxis, :]
+
+
+def _assign(x, centroids, batch_size=16384):
+    """
+    Return the idx of the nearest (L2) centroid of every row of x
+    """
+    assignments = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), batch_size):
+        assignments[start:start + batch_size] = _squared_distances(x[start:start + batch_size], centroids).argmin(1)
+    return assignments
+
+
+def _kmeans(x, k, niter, rng):
+    """
+    Lloyd's k-means, with empty clusters reseeded from random points
+    """
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(niter):
+        assignments = _assign(x, centroids)
+
+        # sum the points of every cluster at once
+        order = np.argsort(assignments, kind="stable")
+        clusters, starts, counts = np.unique(assignments[order], return_index=True, return_counts=True)
+        centroids[clusters] = np.add.reduceat(x[order], starts, axis=0) / counts[:, np.newaxis]
+
+        empty = np.setdiff1d(np.arange(k), clusters)
+        if len(empty) > 0:
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    return centroids
+
+
+class IVFPQIndex():
+    """
+    Approximate inner product search over dictionary embeddings. The embeddings are partitioned
+    with a coarse k-means (IVF), and the residual of every embedding to its partition centroid is
+    compressed with product quantization (PQ). A search only visits the nprobe partitions whose
+    centroids score highest for the query, and scores their rows from the PQ codes
+    """
+
+    def __init__(self, nlist=256, m=16, ksub=256, nprobe=8, niter=20, seed=0):
+        """
+        Parameters
+        ----------
+        nlist : int
+            The number of coarse partitions
+        m : int
+            The number of PQ sub-vectors (must divide the embedding size)
+        ksub : int
+            The number of centroids per PQ sub-vector (at most 256, codes are stored as uint8)
+        nprobe : int
+            The number of partitions visited per query
+        niter : int
+            The number of k-means iterations used in training
+        """
+        assert ksub <= 256
+        self.nlist = nlist
+        self.m = m
+        self.ksub = ksub
+        self.nprobe = nprobe
+        self.niter = niter
+        self.seed = seed
+
+        self.centroids = None  # [nlist, hidden]
+        self.codebooks = None  # [m, ksub, hidden / m]
+        self.codes = None  # [# of dict, m], rows sorted by partition
+        self.ids = None  # [# of dict], dictionary idx of every sorted row
+        self.list_ids = None  # [# of dict], partition of every sorted row
+        self.list_offsets = None  # [nlist + 1], start of every partition in the sorted rows
+        self.fingerprint = None  # key of the model and dictionary the index was built from
+
+    @property
+    def is_trained(self):
+        return self.codes is not None
+
+    def build(self, dict_embeds):
+        """
+        Train the coarse and PQ quantizers on the dictionary embeddings, and encode them
+
+        Parameters
+        ----------
+        dict_embeds : np.array
+            2d numpy array of dictionary embeddings
+        """
+        dict_embeds = np.asarray(dict_embeds, dtype=np.float32)
+        num_dict, hidden = dict_embeds.shape
+        if hidden % self.m != 0:
+            raise ValueError("embedding size {} is not divisible by m={}".format(hidden, self.m))
+        LOGGER.info("IVFPQIndex! # of dict={} nlist={} m={} ksub={}".format(num_dict, self.nlist, self.m, self.ksub))
+        rng = np.random.default_rng(self.seed)
+        self.nlist = min(self.nlist, num_dict)
+        self.ksub = min(self.ksub, num_dict)
+
+        # coarse quantizer, trained on a sample of the dictionary
+        sample = dict_embeds[rng.choice(num_dict, min(num_dict, self.nlist * 64), replace=False)]
+        self.centroids = _kmeans(sample, self.nlist, self.niter, rng)
+        assignments = _assign(dict_embeds, self.centroids)
+        residuals = dict_embeds - self.centroids[assignments]
+
+        # product quantizer of the residuals, one codebook per sub-vector
+        dsub = hidden // self.m
+        sample = residuals[rng.choice(num_dict, min(num_dict, self.ksub * 64), replace=False)]
+        self.codebooks = np.empty((self.m, self.ksub, dsub), dtype=np.float32)
+        codes = np.empty((num_dict, self.m), dtype=np.uint8)
+        for i in tqdm(range(self.m), desc="- Training PQ"):
+            sub = slice(i * dsub, (i + 1) * dsub)
+            self.codebooks[i] = _kmeans(sample[:, sub], self.ksub, self.niter, rng)
+            codes[:, i] = _assign(np.ascontiguousarray(residuals[:, sub]), self.codebooks[i])
+
+        # sort the rows by partition, so every partition is a contiguous slice
+        order = np.argsort(assignments, kind="stable")
+        self.ids = order
+        self.codes = codes[order]
+        self.list_ids = assignments[order]
+        self.list_offsets = np.searchsorted(self.list_ids, np.arange(self.nlist + 1))
+
+        return self
+
+    def search(self, query_embeds, topk, nprobe=None, batch_size=1024):
+        """
+        Return approximate sorted topk scores and idxes (descending order)
+
+        Parameters
+        ----------
+        query_embeds : np.array
+            2d numpy array of query embeddings
+        topk : int
+            The number of candidates
+        nprobe : int
+            The number of partitions visited per query (defaults to self.nprobe)
+        batch_size : int
+            The number of queries scored at once against a partition
+
+        Returns
+        -------
+        topk_scores : np.array
+            2d numpy array of scores [# of query, topk]
+        topk_idxs : np.array
+            2d numpy array of dictionary idxes [# of query, topk], padded with -1 if fewer
+            than topk rows were visited
+        """
+        assert self.is_trained
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        query_embeds = np.asarray(query_embeds, dtype=np.float32)
+        num_queries = query_embeds.shape[0]
+
+        # score of every query against every PQ centroid: [# of query, m, ksub]
+        sub_queries = query_embeds.reshape(num_queries, self.m, -1)
+        lookup_tables = np.einsum("qmd,mkd->qmk", sub_queries, self.codebooks)
+
+        coarse_scores = np.matmul(query_embeds, self.centroids.T)
+        probes = np.argpartition(-coarse_scores, nprobe - 1, axis=1)[:, :nprobe]
+
+        # visit the partitions one at a time, scoring all the queries that probe a partition at once,
+        # and keep the topk of every (query, probe) in its own slot of the candidate buffer
+        candidate_scores = np.full((num_queries, nprobe * topk), -np.inf, dtype=np.float32)
+        candidate_rows = np.full((num_queries, nprobe * topk), -1, dtype=np.int64)
+        probed = np.argsort(probes, axis=None, kind="stable")
+        lists = probes.ravel()[probed]
+        bounds = np.searchsorted(lists, np.arange(self.nlist + 1))
+        for l in np.flatnonzero(np.diff(bounds)):
+            start, end = self.list_offsets[l], self.list_offsets[l + 1]
+            if start == end:
+                continue
+            codes = self.codes[start:end]
+            k = min(topk, end - start)
+            for batch_start in range(bounds[l], bounds[l + 1], batch_size):
+                batch = probed[batch_start:min(batch_start + batch_size, bounds[l + 1])]
+                qs, slots = np.divmod(batch, nprobe)
+                scores = np.repeat(coarse_scores[qs, l][:, np.newaxis], end - start, axis=1)
+                for i in range(self.m):
+                    scores += lookup_tables[qs, i][:, codes[:, i]]
+                if k < end - start:
+                    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                else:
+                    best = np.broadcast_to(np.arange(k), (len(qs), k))
+                columns = slots[:, np.newaxis] * topk + np.arange(k)
+                candidate_scores[qs[:, np.newaxis], columns] = np.take_along_axis(scores, best, axis=1)
+                candidate_rows[qs[:, np.newaxis], columns] = start + best
+
+        # merge the candidates of the nprobe partitions of every query
+        best = np.argsort(-candidate_scores, axis=1, kind="stable")[:, :topk]
+        topk_scores = np.take_along_axis(candidate_scores, best, axis=1)
+        topk_rows = np.take_along_axis(candidate_rows, best, axis=1)
+        topk_idxs = np.where(topk_rows >= 0, self.ids[np.maximum(topk_rows, 0)], -1)
+
+        return topk_scores, topk_idxs
+
+    def save(self, path):
+        assert self.is_trained
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                config=np.array([self.nlist, self.m, self.ksub, self.nprobe, self.niter, self.seed]),
+                fingerprint=np.array(self.fingerprint or ""),
+                centroids=self.centroids,
+                codebooks=self.codebooks,
+                codes=self.codes,
+                ids=self.ids,
+                list_ids=self.list_ids,
+                list_offsets=self.list_offsets,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            nlist, m, ksub, nprobe, niter, seed = data["config"].tolist()
+            index = cls(nlist=nlist, m=m, ksub=ksub, nprobe=nprobe, niter=niter, seed=seed)
+            index.centroids = data["centroids"]
+            index.codebooks = data["codebooks"]
+            index.codes = data["codes"]
+            index.ids = data["ids"]
+            index.list_ids = data["list_ids"]
+            index.list_offsets = data["list_offsets"]
+            index.fingerprint = (str(data["fingerprint"]) or None) if "fingerprint" in data.files else None
+        return index
@@ -0,0 +1,55 @@
+import os
+import hashlib
+import logging
+import numpy as np
+
+from .embedding_cache import fingerprint_model, fingerprint_names
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CandidateCache():
+    """
+    On-disk cache of the top-k dictionary candidates of a list of queries, stored as compact
+    .npz files (int32 idxes and float32 scores). Experiments that only change the scoring rule
+    (label matching, k, score thresholds) can then re-read the candidates instead of embedding
+    and searching again
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            The directory where the candidates are stored
+        """
+        LOGGER.info("CandidateCache! cache_dir={}".format(cache_dir))
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def model_key(self, model_wrapper, agg_mode):
+        return fingerprint_model(model_wrapper, agg_mode)
+
+    def path(self, model_key, dict_names, query_texts, topk):
+        key = hashlib.sha1("{}|{}|{}|{}".format(
+            model_key, fingerprint_names(dict_names), fingerprint_names(query_texts), topk
+        ).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "{}.npz".format(key))
+
+    def load(self, path):
+        """
+        Return the cached (topk_scores, topk_idxs) stored at path, or None on a miss
+        """
+        if not os.path.exists(path):
+            LOGGER.info("CandidateCache miss! path={}".format(path))
+            return None
+        LOGGER.info("CandidateCache hit! path={}".format(path))
+        with np.load(path) as data:
+            return data["scores"], data["idxs"].astype(np.int64)
+
+    def save(self, path, topk_scores, topk_idxs):
+        # write to a temporary file first, so concurrent readers never see a partial file
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, scores=np.asarray(topk_scores, dtype=np.float32), idxs=np.asarray(topk_idxs, dtype=np.int32))
+        os.replace(tmp_path, path)
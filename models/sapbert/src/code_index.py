@@ -0,0 +1,129 @@
+import logging
+import numpy as np
+from tqdm import tqdm
+
+from .ann_index import _assign, _kmeans
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CodeIndex():
+    """
+    Reduced search matrix over dictionary embeddings, with either the centroid of every code or up
+    to k medoids (synonyms nearest to the k-means centers of the code) per code. Top-1 prediction
+    only needs the best code, so the queries are searched against the reduced matrix, and the
+    synonyms of the best codes can optionally be re-checked exactly
+    """
+
+    def __init__(self, dict_embeds, codes, mode="centroid", num_medoids=1, seed=0):
+        """
+        Parameters
+        ----------
+        dict_embeds : np.array
+            2d numpy array of float32 dictionary embeddings
+        codes : list
+            The code of every dictionary row
+        mode : str
+            "centroid" (one mean embedding per code) or "medoid" (up to num_medoids synonyms per code)
+        num_medoids : int
+            The number of medoids per code, in medoid mode
+        """
+        LOGGER.info("CodeIndex! # of dict={} mode={} num_medoids={}".format(len(dict_embeds), mode, num_medoids))
+        dict_embeds = np.asarray(dict_embeds, dtype=np.float32)
+        self.mode = mode
+
+        # dictionary rows sorted by code, so the synonyms of every code are a contiguous slice
+        self.codes, code_ids = np.unique(np.asarray(codes, dtype=object).astype(str), return_inverse=True)
+        self.order = np.argsort(code_ids, kind="stable")
+        self.code_offsets = np.searchsorted(code_ids[self.order], np.arange(len(self.codes) + 1))
+        counts = np.diff(self.code_offsets)
+
+        if mode == "centroid":
+            self.embeds = np.add.reduceat(dict_embeds[self.order], self.code_offsets[:-1], axis=0) / counts[:, np.newaxis]
+            self.embeds = self.embeds.astype(np.float32)
+            self.row_codes = np.arange(len(self.codes))
+            # the synonym nearest to its centroid stands for the code when there is no re-check
+            sorted_code_ids = code_ids[self.order]
+            scores = np.einsum("nd,nd->n", dict_embeds[self.order], self.embeds[sorted_code_ids])
+            is_best = scores == np.repeat(np.maximum.reduceat(scores, self.code_offsets[:-1]), counts)
+            best = np.flatnonzero(is_best)
+            self.row_idxs = self.order[best[np.unique(sorted_code_ids[best], return_index=True)[1]]]
+        elif mode == "medoid":
+            rng = np.random.default_rng(seed)
+            row_idxs = []
+            for code_id, (start, end) in enumerate(tqdm(
+                zip(self.code_offsets[:-1], self.code_offsets[1:]), total=len(self.codes), desc="- Medoids"
+            )):
+                members = self.order[start:end]
+                if len(members) <= num_medoids:
+                    row_idxs.append(members)
+                    continue
+                centers = _kmeans(dict_embeds[members], num_medoids, 10, rng)
+                nearest = _assign(centers, dict_embeds[members])
+                row_idxs.append(members[np.unique(nearest)])
+            self.row_idxs = np.concatenate(row_idxs)
+            self.row_codes = np.repeat(np.arange(len(self.codes)), [len(idxs) for idxs in row_idxs])
+            self.embeds = dict_embeds[self.row_idxs]
+        else:
+            raise NotImplementedError("no such mode: {}".format(mode))
+
+    def __len__(self):
+        return len(self.embeds)
+
+    @property
+    def nbytes(self):
+        return self.embeds.nbytes
+
+    def search(self, model_wrapper, query_embeds, topk=1, dict_embeds=None, recheck_codes=None):
+        """
+        Return sorted topk scores and dictionary idxes (descending order)
+
+        Parameters
+        ----------
+        model_wrapper : Model_Wrapper
+            The wrapper whose blocked search scores the reduced matrix
+        query_embeds : np.array
+            2d numpy array of query embeddings
+        topk : int
+            The number of candidates
+        dict_embeds : np.array
+            2d numpy array of float32 dictionary embeddings, used by the re-check
+        recheck_codes : int
+            If given (with dict_embeds), all the synonyms of the best recheck_codes codes are scored
+            exactly, and the topk synonyms are kept
+
+        Returns
+        -------
+        topk_scores : np.array
+            2d numpy array of scores [# of query, topk]
+        topk_idxs : np.array
+            2d numpy array of dictionary idxes [# of query, topk]
+        """
+        if dict_embeds is None or recheck_codes is None:
+            scores, rows = model_wrapper.retrieve_candidate_blocked(
+                query_embeds=query_embeds,
+                dict_embeds=self.embeds,
+                topk=min(topk, len(self.embeds)),
+            )
+            return scores, self.row_idxs[rows]
+
+        # medoid rows of a code can fill several slots, so search more rows than codes
+        num_rows = min(len(self.embeds), recheck_codes * (len(self.embeds) // len(self.codes) + 1))
+        _, rows = model_wrapper.retrieve_candidate_blocked(
+            query_embeds=query_embeds,
+            dict_embeds=self.embeds,
+            topk=num_rows,
+        )
+        query_embeds = np.asarray(query_embeds, dtype=np.float32)
+        topk_scores = np.full((len(query_embeds), topk), -np.inf, dtype=np.float32)
+        topk_idxs = np.full((len(query_embeds), topk), -1, dtype=np.int64)
+        for i, code_ids in enumerate(self.row_codes[rows]):
+            code_ids = code_ids[np.sort(np.unique(code_ids, return_index=True)[1])][:recheck_codes]
+            members = np.sort(np.concatenate([
+                self.order[self.code_offsets[code_id]:self.code_offsets[code_id + 1]] for code_id in code_ids
+            ]))
+            scores = np.matmul(np.asarray(dict_embeds[members], dtype=np.float32), query_embeds[i])
+            best = np.argsort(-scores, kind="stable")[:topk]
+            topk_scores[i, :len(best)] = scores[best]
+            topk_idxs[i, :len(best)] = members[best]
+        return topk_scores, topk_idxs
@@ -0,0 +1,92 @@
+import logging
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CompactEmbeddings():
+    """
+    Compact storage of dictionary embeddings, either as float16 or as int8 with one float32 scale
+    per row (row ~= data[row] * scales[row]). Scores are computed block by block against the
+    compact rows, and the best candidates can be rescored exactly against float32 embeddings
+    """
+
+    def __init__(self, dict_embeds, dtype="int8"):
+        """
+        Parameters
+        ----------
+        dict_embeds : np.array
+            2d numpy array of float32 dictionary embeddings
+        dtype : str
+            "int8" or "float16"
+        """
+        LOGGER.info("CompactEmbeddings! # of dict={} dtype={}".format(len(dict_embeds), dtype))
+        self.dtype = dtype
+        self.scales = None
+        if dtype == "float16":
+            self.data = np.asarray(dict_embeds, dtype=np.float16)
+        elif dtype == "int8":
+            self.data = np.empty(dict_embeds.shape, dtype=np.int8)
+            self.scales = np.empty(len(dict_embeds), dtype=np.float32)
+            for start in range(0, len(dict_embeds), 16384):
+                block = np.asarray(dict_embeds[start:start + 16384], dtype=np.float32)
+                scales = np.abs(block).max(1) / 127
+                scales[scales == 0] = 1
+                self.data[start:start + 16384] = np.rint(block / scales[:, np.newaxis])
+                self.scales[start:start + 16384] = scales
+        else:
+            raise NotImplementedError("no such dtype: {}".format(dtype))
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def search(self, model_wrapper, query_embeds, topk, dict_embeds=None, rescore_topk=None):
+        """
+        Return sorted topk scores and idxes (descending order)
+
+        Parameters
+        ----------
+        model_wrapper : Model_Wrapper
+            The wrapper whose blocked search scores the compact rows
+        query_embeds : np.array
+            2d numpy array of query embeddings
+        topk : int
+            The number of candidates
+        dict_embeds : np.array
+            2d numpy array of float32 dictionary embeddings (can be memory-mapped), used to rescore
+        rescore_topk : int
+            If given (with dict_embeds), the best rescore_topk compact candidates are rescored
+            exactly in float32 before keeping the topk
+
+        Returns
+        -------
+        topk_scores : np.array
+            2d numpy array of scores [# of query, topk]
+        topk_idxs : np.array
+            2d numpy array of dictionary idxes [# of query, topk]
+        """
+        rescore = dict_embeds is not None and rescore_topk is not None
+        scores, idxs = model_wrapper.retrieve_candidate_blocked(
+            query_embeds=query_embeds,
+            dict_embeds=self.data,
+            topk=max(topk, rescore_topk) if rescore else topk,
+            dict_scales=self.scales,
+        )
+        if rescore:
+            scores, idxs = rescore_candidates(query_embeds, dict_embeds, idxs, topk)
+        return scores, idxs
+
+
+def rescore_candidates(query_embeds, dict_embeds, candidate_idxs, topk):
+    """
+    Score candidates exactly against float32 dictionary embeddings, and keep the sorted topk
+    """
+    query_embeds = np.asarray(query_embeds, dtype=np.float32)
+    scores = np.empty(candidate_idxs.shape, dtype=np.float32)
+    for i, idxs in enumerate(candidate_idxs):
+        # sorted reads are friendlier to memory-mapped embeddings
+        order = np.argsort(idxs)
+        scores[i, order] = np.matmul(np.asarray(dict_embeds[idxs[order]], dtype=np.float32), query_embeds[i])
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :topk]
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(candidate_idxs, order, axis=1)
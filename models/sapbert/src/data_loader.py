@@ -306,36 +306,134 @@ class DictionaryDataset():
         return data
 
 
+def get_subset_idxs(names, subset_names):
+    """
+    Express a dictionary subset as row idxes over a complete dictionary, so the subset can
+    reuse the complete dictionary embeddings. Embeddings only depend on the name, so any row
+    with the same name can stand for a subset row
+
+    Parameters
+    ----------
+    names : list
+        The names of the complete dictionary
+    subset_names : list
+        The names of the subset
+
+    Returns
+    -------
+    subset_idxs : np.array
+        The idx in names of every name in subset_names, or None if some name is missing
+    """
+    name_to_idx = {}
+    for idx, name in enumerate(names):
+        name_to_idx.setdefault(name, idx)
+    try:
+        return np.array([name_to_idx[name] for name in subset_names], dtype=np.int64)
+    except KeyError:
+        return None
+
+
 class MetricLearningDataset_pairwise(Dataset):
     """
     Candidate Dataset for:
         query_tokens, candidate_tokens, label
+
+    With return_name_ids set, items hold idxs into names instead of the names themselves
     """
 
     def __init__(self, path, tokenizer):  # d_ratio, s_score_matrix, s_candidate_idxs):
         with open(path, 'r') as f:
             lines = f.readlines()
         self.query_ids = []
-        self.query_names = []
+        # every unique name is stored once, and pairs are (name id, name id) rows
+        name_to_id = {}
+        query_name_ids = []
         for line in lines:
             line = line.rstrip("\n")
             query_id, name1, name2 = line.split("||")
             self.query_ids.append(query_id)
-            self.query_names.append((name1, name2))
+            query_name_ids.append((name_to_id.setdefault(name1, len(name_to_id)), name_to_id.setdefault(name2, len(name_to_id))))
+        self.names = list(name_to_id)
+        self.query_name_ids = np.array(query_name_ids, dtype=np.int32).reshape(-1, 2)
         self.tokenizer = tokenizer
         self.query_id_2_index_id = {k: v for v, k in enumerate(list(set(self.query_ids)))}
-        LOGGER.info("TrainingDataset! data_dir={}".format(path))
+        self.return_name_ids = False
+        LOGGER.info("TrainingDataset! data_dir={} # of names={}".format(path, len(self.names)))
 
     def __getitem__(self, query_idx):
-        query_name1 = self.query_names[query_idx][0]
-        query_name2 = self.query_names[query_idx][1]
+        name_id1, name_id2 = self.query_name_ids[query_idx]
         query_id = self.query_ids[query_idx]
         query_id = int(self.query_id_2_index_id[query_id])
 
-        return query_name1, query_name2, query_id
+        if self.return_name_ids:
+            return int(name_id1), int(name_id2), query_id
+        return self.names[name_id1], self.names[name_id2], query_id
 
     def __len__(self):
-        return len(self.query_names)
+        return len(self.query_name_ids)
+
+
+class MetricLearningDataset_grouped(Dataset):
+    """
+    Code-grouped dataset for:
+        query_name1, query_name2, label
+
+    The training file holds one code||name line per synonym, and every unique name is stored once.
+    Every name of a code with at least two names is an anchor, whose positive is sampled on the fly
+    from the other names of its code, so an epoch has one pair per anchor (times pairs_per_name)
+    instead of every k(k-1)/2 pair combination. With return_name_ids set, items hold idxs into
+    names instead of the names themselves
+    """
+
+    def __init__(self, path, tokenizer, pairs_per_name=1, seed=0):
+        self.tokenizer = tokenizer
+        self.pairs_per_name = pairs_per_name
+        self.seed = seed
+        self.epoch = 0
+
+        name_to_id, code_to_id = {}, {}
+        rows = set()
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line == "": continue
+                code, name = line.split("||")
+                rows.add((code_to_id.setdefault(code, len(code_to_id)), name_to_id.setdefault(name, len(name_to_id))))
+        self.names = list(name_to_id)
+        self.codes = list(code_to_id)
+
+        # rows sorted by code, so the names of every code are a contiguous slice
+        rows = np.array(sorted(rows), dtype=np.int32).reshape(-1, 2)
+        self.code_ids, self.name_ids = rows[:, 0], rows[:, 1]
+        self.code_offsets = np.searchsorted(self.code_ids, np.arange(len(self.codes) + 1)).astype(np.int64)
+        counts = np.diff(self.code_offsets)
+        self.anchors = np.flatnonzero(counts[self.code_ids] >= 2).astype(np.int64)
+        self.return_name_ids = False
+        LOGGER.info("TrainingDataset! data_dir={} # of names={} # of codes={} # of anchors={}".format(
+            path, len(self.names), len(self.codes), len(self.anchors)
+        ))
+
+    def set_epoch(self, epoch):
+        """
+        Positives are a function of (seed, epoch, idx), so they change every epoch, and DataLoader
+        workers draw the same positives as the main process would
+        """
+        self.epoch = epoch
+
+    def __getitem__(self, query_idx):
+        row = self.anchors[query_idx % len(self.anchors)]
+        code_id = self.code_ids[row]
+        start, end = self.code_offsets[code_id], self.code_offsets[code_id + 1]
+        rng = np.random.default_rng((self.seed, self.epoch, query_idx))
+        positive = start + rng.integers(end - start - 1)
+        if positive >= row:
+            positive += 1
+        if self.return_name_ids:
+            return int(self.name_ids[row]), int(self.name_ids[positive]), int(code_id)
+        return self.names[self.name_ids[row]], self.names[self.name_ids[positive]], int(code_id)
+
+    def __len__(self):
+        return len(self.anchors) * self.pairs_per_name
 
 
 class MetricLearningDataset(Dataset):
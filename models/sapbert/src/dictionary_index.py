@@ -0,0 +1,243 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+
+from .embedding_cache import fingerprint_model
+
+LOGGER = logging.getLogger(__name__)
+
+
+def row_key(name, code):
+    """
+    Content hash of a (name, code) dictionary row
+    """
+    return hashlib.sha1("{}||{}".format(code, name).encode("utf-8")).hexdigest()
+
+
+class DictionaryIndex():
+    """
+    Embedded dictionary that can be updated row by row. Rows are keyed by a content hash of
+    (name, code); removed rows are tombstoned and dropped later by compact(). For an unchanged
+    encoder, only names that have never been embedded before go through the encoder
+    """
+
+    def __init__(self, agg_mode="cls"):
+        self.agg_mode = agg_mode
+        self.model_key = None
+        self.rows = []  # (name, code) of every stored row, aligned with embeds
+        self.embeds = None  # [capacity, hidden], only the first len(rows) are used
+        self.alive = np.zeros(0, dtype=bool)
+        self.key_to_row = {}
+        self.name_to_row = {}
+        self.lock = threading.RLock()
+        self.compaction = None
+        self.generation = 0  # bumped whenever row idxes are reassigned
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def _check_model(self, model_wrapper):
+        """
+        Drop every embedding if the model changed since they were computed
+        """
+        model_key = fingerprint_model(model_wrapper, self.agg_mode)
+        if model_key != self.model_key:
+            if self.rows:
+                LOGGER.info("DictionaryIndex! model changed, re-embedding {} rows".format(len(self)))
+            alive_rows = [row for row, alive in zip(self.rows, self.alive) if alive]
+            self.model_key = model_key
+            self.rows, self.embeds, self.alive = [], None, np.zeros(0, dtype=bool)
+            self.key_to_row, self.name_to_row = {}, {}
+            self.generation += 1
+            return alive_rows
+        return []
+
+    def _append(self, rows, embeds):
+        num_rows = len(self.rows)
+        if self.embeds is None:
+            self.embeds = np.empty((max(len(rows), 1024), embeds.shape[1]), dtype=np.float32)
+        if num_rows + len(rows) > len(self.embeds):
+            # grow geometrically, so appends are amortized O(1)
+            grown = np.empty((max(2 * len(self.embeds), num_rows + len(rows)), self.embeds.shape[1]), dtype=np.float32)
+            grown[:num_rows] = self.embeds[:num_rows]
+            self.embeds = grown
+        self.embeds[num_rows:num_rows + len(rows)] = embeds
+        self.alive = np.concatenate([self.alive, np.ones(len(rows), dtype=bool)])
+        for i, (name, code) in enumerate(rows):
+            self.rows.append((name, code))
+            self.key_to_row[row_key(name, code)] = num_rows + i
+            self.name_to_row.setdefault(name, num_rows + i)
+
+    def add(self, model_wrapper, rows, batch_size=4096, check_model=True):
+        """
+        Add (name, code) rows, embedding only the names that are not stored yet
+
+        Parameters
+        ----------
+        model_wrapper : Model_Wrapper
+            The encoder; if it differs from the one the index was built with, every row is re-embedded
+        rows : list
+            (name, code) rows
+        check_model : bool
+            Whether to check the encoder (which hashes its weights), False if the caller just did
+
+        Returns
+        -------
+        num_embedded : int
+            The number of names that went through the encoder
+        """
+        with self.lock:
+            rows = (self._check_model(model_wrapper) if check_model else []) + list(rows)
+            new_rows, new_keys = [], set()
+            for name, code in rows:
+                key = row_key(name, code)
+                row = self.key_to_row.get(key)
+                if row is not None:
+                    self.alive[row] = True
+                elif key not in new_keys:
+                    new_rows.append((name, code))
+                    new_keys.add(key)
+            if not new_rows:
+                return 0
+
+            names_to_embed = list(dict.fromkeys(name for name, _ in new_rows if name not in self.name_to_row))
+            new_embeds = {}
+            if names_to_embed:
+                dense_embeds = model_wrapper.embed_dense(
+                    names=names_to_embed, batch_size=batch_size, agg_mode=self.agg_mode, use_cache=False
+                )
+                new_embeds = dict(zip(names_to_embed, dense_embeds))
+            embeds = np.stack([
+                new_embeds[name] if name in new_embeds else self.embeds[self.name_to_row[name]]
+                for name, _ in new_rows
+            ])
+            self._append(new_rows, embeds)
+            LOGGER.info("DictionaryIndex! added {} rows, embedded {} names".format(len(new_rows), len(names_to_embed)))
+            return len(names_to_embed)
+
+    def remove(self, rows):
+        """
+        Tombstone (name, code) rows
+        """
+        with self.lock:
+            for name, code in rows:
+                row = self.key_to_row.get(row_key(name, code))
+                if row is not None:
+                    self.alive[row] = False
+
+    def replace(self, model_wrapper, old_rows, new_rows):
+        with self.lock:
+            self.remove(old_rows)
+            return self.add(model_wrapper, new_rows)
+
+    def sync(self, model_wrapper, dictionary):
+        """
+        Update the index to hold exactly the rows of dictionary (duplicate rows are stored once)
+        """
+        with self.lock:
+            self._check_model(model_wrapper)
+            wanted = {row_key(name, code): (name, code) for name, code in dictionary}
+            self.remove([
+                row for row, alive in zip(self.rows, self.alive)
+                if alive and row_key(*row) not in wanted
+            ])
+            return self.add(model_wrapper, wanted.values(), check_model=False)
+
+    def compact(self, background=False):
+        """
+        Drop the tombstoned rows. The compacted arrays are built from a snapshot without holding
+        the lock, which is only taken to snapshot and to swap them in, so in the background the
+        index stays usable. Rows added, removed or revived meanwhile are carried over at the swap
+        """
+        if background:
+            if self.compaction is None or not self.compaction.is_alive():
+                self.compaction = threading.Thread(target=self.compact, daemon=True)
+                self.compaction.start()
+            return self.compaction
+
+        with self.lock:
+            keep = np.flatnonzero(self.alive)
+            if len(keep) == len(self.rows):
+                return
+            # stored rows and embeddings are never rewritten in place (appends only write past
+            # them, and resets replace the containers), so they can be read after the lock is released
+            rows, embeds, generation = self.rows, self.embeds, self.generation
+
+        compacted = DictionaryIndex(self.agg_mode)
+        compacted._append([rows[i] for i in keep], embeds[keep])
+
+        with self.lock:
+            if generation != self.generation:
+                LOGGER.info("DictionaryIndex! rows changed during compaction, dropping it")
+                return
+            compacted.alive = self.alive[keep]
+            new_rows = np.setdiff1d(np.flatnonzero(self.alive), keep)
+            if len(new_rows):
+                compacted._append([self.rows[i] for i in new_rows], self.embeds[new_rows])
+            self.rows, self.embeds, self.alive = compacted.rows, compacted.embeds, compacted.alive
+            self.key_to_row, self.name_to_row = compacted.key_to_row, compacted.name_to_row
+            self.generation += 1
+            LOGGER.info("DictionaryIndex! compacted to {} rows".format(len(self.rows)))
+
+    @property
+    def num_tombstones(self):
+        return len(self.rows) - len(self)
+
+    def compact_if_needed(self, max_tombstone_fraction=0.25):
+        """
+        Compact (in the foreground) once more than max_tombstone_fraction of the stored rows are tombstoned
+        """
+        self.wait_for_compaction()
+        if self.num_tombstones > max_tombstone_fraction * len(self.rows):
+            self.compact()
+
+    def wait_for_compaction(self):
+        if self.compaction is not None:
+            self.compaction.join()
+
+    def dictionary(self, rows=None):
+        """
+        Return the alive (name, code) rows and their embeddings, compacting first if needed
+
+        Parameters
+        ----------
+        rows : list
+            If given, return these (name, code) rows, all of them stored and alive, in their own
+            order (duplicates included) instead of the index order
+        """
+        if rows is not None:
+            with self.lock:
+                rows = list(rows)
+                idxs = np.array([self.key_to_row[row_key(name, code)] for name, code in rows], dtype=np.int64)
+                assert self.alive[idxs].all(), "some rows were removed from the index"
+                return rows, self.embeds[idxs]
+
+        self.wait_for_compaction()
+        self.compact()
+        with self.lock:
+            return list(self.rows), self.embeds[:len(self.rows)]
+
+    def save(self, index_dir):
+        self.wait_for_compaction()
+        with self.lock:
+            os.makedirs(index_dir, exist_ok=True)
+            num_rows = len(self.rows)
+            np.save(os.path.join(index_dir, "embeds.npy"), self.embeds[:num_rows] if num_rows else np.zeros((0, 0)))
+            np.save(os.path.join(index_dir, "alive.npy"), self.alive)
+            with open(os.path.join(index_dir, "rows.json"), "w") as f:
+                json.dump({"model_key": self.model_key, "agg_mode": self.agg_mode, "rows": self.rows}, f)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, "rows.json"), "r") as f:
+            info = json.load(f)
+        index = cls(agg_mode=info["agg_mode"])
+        index.model_key = info["model_key"]
+        rows = [tuple(row) for row in info["rows"]]
+        if rows:
+            index._append(rows, np.load(os.path.join(index_dir, "embeds.npy")))
+            index.alive = np.load(os.path.join(index_dir, "alive.npy"))
+        return index
@@ -0,0 +1,164 @@
+import os
+import json
+import hashlib
+import logging
+import torch
+import numpy as np
+
+from .sharded_embedding import embed_dense_sharded
+
+LOGGER = logging.getLogger(__name__)
+
+
+def fingerprint_encoder(encoder):
+    """
+    Hash of the encoder weights
+    """
+    sha = hashlib.sha1()
+    for name, value in encoder.state_dict().items():
+        sha.update(name.encode("utf-8"))
+        # dynamically quantized linear layers store (weight, bias) tuples of packed params
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if not isinstance(tensor, torch.Tensor):
+                sha.update(repr(tensor).encode("utf-8"))
+                continue
+            if tensor.is_quantized:
+                tensor = tensor.dequantize()
+            sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def fingerprint_file(path):
+    """
+    Hash of the content of a file
+    """
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def fingerprint_tokenizer(tokenizer):
+    """
+    Hash of the tokenizer vocabulary and settings
+    """
+    sha = hashlib.sha1()
+    sha.update(type(tokenizer).__name__.encode("utf-8"))
+    if getattr(tokenizer, "is_fast", False):
+        # the serialized fast tokenizer covers the vocab, normalizer, pre-tokenizer and post-processor,
+        # but also the truncation and padding state that every tokenizer call sets, which is left out
+        state = json.loads(tokenizer.backend_tokenizer.to_str())
+        state.pop("truncation", None)
+        state.pop("padding", None)
+        sha.update(json.dumps(state, sort_keys=True).encode("utf-8"))
+    else:
+        sha.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    sha.update(str(getattr(tokenizer, "do_lower_case", None)).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def fingerprint_names(names):
+    """
+    Hash of an ordered list of names (the only part of a dictionary that affects its embeddings)
+    """
+    sha = hashlib.sha1()
+    for name in names:
+        sha.update(name.encode("utf-8"))
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+
+def fingerprint_model(model_wrapper, agg_mode):
+    """
+    Hash of everything on the model side that affects the embeddings: the encoder weights, the
+    tokenizer, agg_mode and max_length
+    """
+    sha = hashlib.sha1()
+    if model_wrapper.onnx_path is not None:
+        sha.update(fingerprint_file(model_wrapper.onnx_path).encode("utf-8"))
+    else:
+        sha.update(fingerprint_encoder(model_wrapper.get_dense_encoder()).encode("utf-8"))
+    sha.update(fingerprint_tokenizer(model_wrapper.get_dense_tokenizer()).encode("utf-8"))
+    sha.update("{}|{}".format(agg_mode, model_wrapper.max_length).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class EmbeddingCache():
+    """
+    On-disk cache of dictionary embeddings, stored as .npy files that are memory-mapped read-only
+    when loaded, so several processes evaluating the same checkpoint share a single copy
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            The directory where the embeddings are stored
+        """
+        LOGGER.info("EmbeddingCache! cache_dir={}".format(cache_dir))
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def model_key(self, model_wrapper, agg_mode):
+        """
+        Key of everything on the model side that affects the embeddings. It hashes the encoder
+        weights, so it should be computed once and reused for every dictionary of a given model
+        """
+        return fingerprint_model(model_wrapper, agg_mode)
+
+    def path(self, model_key, names):
+        key = hashlib.sha1("{}|{}".format(model_key, fingerprint_names(names)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "{}.npy".format(key))
+
+    def embed_dense(self, model_wrapper, names, agg_mode="cls", model_key=None, description=None, num_workers=1,
+                    model_dir=None, token_store=None):
+        """
+        Return the embeddings of names, computing and storing them only if they are not cached yet
+
+        Parameters
+        ----------
+        model_wrapper : Model_Wrapper
+            The model used to embed the names on a cache miss
+        names : list
+            A list of names
+        model_key : str
+            The result of model_key, computed here if not given
+        num_workers : int
+            If greater than 1, a cache miss is embedded by that many CPU processes (see embed_dense_sharded)
+        model_dir : str
+            Passed on to embed_dense_sharded
+        token_store : TokenStore
+            Passed on to Model_Wrapper.embed_dense (or embed_dense_sharded)
+
+        Returns
+        -------
+        dense_embeds : np.memmap
+            A read-only memory-mapped array of dense embeddings
+        """
+        if model_key is None:
+            model_key = self.model_key(model_wrapper, agg_mode)
+        path = self.path(model_key, names)
+
+        if os.path.exists(path):
+            LOGGER.info("EmbeddingCache hit! path={}".format(path))
+        else:
+            LOGGER.info("EmbeddingCache miss! path={}".format(path))
+            # write to a temporary file first, so concurrent readers never see a partial file
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            if num_workers > 1:
+                embed_dense_sharded(
+                    model_wrapper, names, tmp_path, num_workers, model_dir=model_dir, agg_mode=agg_mode,
+                    token_store=token_store
+                )
+            else:
+                dense_embeds = model_wrapper.embed_dense(
+                    names=names, show_progress=True, agg_mode=agg_mode, description=description,
+                    token_store=token_store, use_cache=False
+                )
+                with open(tmp_path, "wb") as f:
+                    np.save(f, dense_embeds)
+            os.replace(tmp_path, path)
+
+        return np.load(path, mmap_mode="r")
@@ -0,0 +1,41 @@
+import re
+import logging
+import unicodedata
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+def normalize_name(name):
+    """
+    Lowercase, fold accents and squeeze whitespace
+    """
+    name = unicodedata.normalize("NFKD", name.lower())
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", name).strip()
+
+
+class ExactMatchIndex():
+    """
+    Hashed lookup of normalized dictionary names, used to resolve queries that match
+    a dictionary name without running the encoder
+    """
+
+    def __init__(self, names):
+        """
+        Parameters
+        ----------
+        names : list
+            The names of the dictionary
+        """
+        self.name_to_idx = {}
+        for idx, name in enumerate(names):
+            # the first row with a given normalized name wins
+            self.name_to_idx.setdefault(normalize_name(name), idx)
+        LOGGER.info("ExactMatchIndex! # of dict={} # of normalized names={}".format(len(names), len(self.name_to_idx)))
+
+    def lookup(self, texts):
+        """
+        Return the dictionary idx of every text, or -1 if it matches no dictionary name
+        """
+        return np.array([self.name_to_idx.get(normalize_name(text), -1) for text in texts], dtype=np.int64)
@@ -0,0 +1,101 @@
+import re
+import json
+import logging
+from collections import OrderedDict
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MentionCache():
+    """
+    Bounded LRU cache of mention embeddings. Keys are (agg_mode, normalized mention) pairs; the
+    whole cache is dropped when the encoder fingerprint changes, e.g. after Model_Wrapper.invalidate
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        Parameters
+        ----------
+        max_size : int
+            The largest number of cached embeddings, the least recently used ones are evicted first
+        """
+        LOGGER.info("MentionCache! max_size={}".format(max_size))
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def check_fingerprint(self, fingerprint):
+        if fingerprint != self.fingerprint:
+            if self.entries:
+                LOGGER.info("MentionCache! encoder changed, dropping {} embeddings".format(len(self.entries)))
+            self.entries.clear()
+            self.fingerprint = fingerprint
+
+    def get(self, key):
+        embed = self.entries.get(key)
+        if embed is not None:
+            self.entries.move_to_end(key)
+        return embed
+
+    def put(self, key, embed):
+        self.entries[key] = embed
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self.entries),
+            'max_size': self.max_size,
+        }
+
+
+def normalize_mention(name, squeeze_whitespace=False, lowercase=False):
+    """
+    Normalize a mention only in ways that do not change its token ids (see mention_normalization)
+    """
+    if squeeze_whitespace:
+        name = re.sub(r"\s+", " ", name).strip()
+    return name.lower() if lowercase else name
+
+
+def mention_normalization(tokenizer):
+    """
+    Return (squeeze_whitespace, lowercase): whether the pre-tokenizer of a fast tokenizer splits on
+    whitespace (so runs of whitespace are irrelevant) and whether its normalizer lowercases. Both
+    are False when unknown
+    """
+    if not getattr(tokenizer, "is_fast", False):
+        return False, False
+
+    def find(component, matches):
+        if not component:
+            return False
+        if matches(component):
+            return True
+        children = component.get("normalizers", []) + component.get("pretokenizers", [])
+        return any(find(child, matches) for child in children)
+
+    state = json.loads(tokenizer.backend_tokenizer.to_str())
+    squeeze_whitespace = find(
+        state.get("pre_tokenizer"), lambda c: c.get("type") in ("BertPreTokenizer", "Whitespace", "WhitespaceSplit")
+    )
+    lowercase = find(
+        state.get("normalizer"),
+        lambda c: c.get("type") == "Lowercase" or (c.get("type") == "BertNormalizer" and c.get("lowercase"))
+    )
+    return squeeze_whitespace, lowercase
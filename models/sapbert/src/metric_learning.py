@@ -10,14 +10,29 @@ from pytorch_metric_learning import miners, losses, distances
 LOGGER = logging.getLogger(__name__)
 
 
+def pool(last_hidden_state, attention_mask, agg_mode):
+    """
+    Aggregate the token states of a batch into one embedding per name
+    """
+    if agg_mode == "cls":
+        return last_hidden_state[:,0,:] # [CLS]
+    elif agg_mode == "mean_all_tok":
+        return last_hidden_state.mean(1) # pooling
+    elif agg_mode == "mean":
+        return (last_hidden_state * attention_mask.unsqueeze(-1)).sum(1) / attention_mask.sum(-1).unsqueeze(-1)
+    else:
+        raise NotImplementedError("no such agg_mode: {}".format(agg_mode))
+
+
 class Sap_Metric_Learning(nn.Module):
     def __init__(
             self, encoder, learning_rate, weight_decay, use_cuda, pairwise, loss,
-            use_miner=True, miner_margin=0.2, type_of_triplets="all", agg_mode="cls"
+            use_miner=True, miner_margin=0.2, type_of_triplets="all", agg_mode="cls", fused_forward=False,
+            pad_token_id=0, padding_side="right"
     ):
         LOGGER.info(
-            "Sap_Metric_Learning! learning_rate={} weight_decay={} use_cuda={} loss={} use_miner={} miner_margin={} type_of_triplets={} agg_mode={}".format(
-            learning_rate, weight_decay, use_cuda, loss, use_miner, miner_margin, type_of_triplets, agg_mode
+            "Sap_Metric_Learning! learning_rate={} weight_decay={} use_cuda={} loss={} use_miner={} miner_margin={} type_of_triplets={} agg_mode={} fused_forward={}".format(
+            learning_rate, weight_decay, use_cuda, loss, use_miner, miner_margin, type_of_triplets, agg_mode, fused_forward
             )
         )
         super(Sap_Metric_Learning, self).__init__()
@@ -30,6 +45,10 @@ class Sap_Metric_Learning(nn.Module):
         self.use_miner = use_miner
         self.miner_margin = miner_margin
         self.agg_mode = agg_mode
+        self.fused_forward = fused_forward
+        # how the tokenizer pads, so the fused forward pads the narrower side the same way
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
         self.optimizer = optim.AdamW([{'params': self.encoder.parameters()},], lr=self.learning_rate, weight_decay=self.weight_decay)
         
         if self.use_miner:
@@ -57,20 +76,19 @@ class Sap_Metric_Learning(nn.Module):
 
         output : (N, topk)
         """
-        
+        if self.fused_forward:
+            query_embed = self.encode_pairs_fused(query_toks1, query_toks2)
+            labels = torch.cat([labels, labels], dim=0)
+            if self.use_miner:
+                hard_pairs = self.miner(query_embed, labels)
+                return self.loss(query_embed, labels, hard_pairs)
+            else:
+                return self.loss(query_embed, labels)
+
         last_hidden_state1 = self.encoder(**query_toks1, return_dict=True).last_hidden_state
         last_hidden_state2 = self.encoder(**query_toks2, return_dict=True).last_hidden_state
-        if self.agg_mode=="cls":
-            query_embed1 = last_hidden_state1[:,0]  # query : [batch_size, hidden]
-            query_embed2 = last_hidden_state2[:,0]  # query : [batch_size, hidden]
-        elif self.agg_mode == "mean_all_tok":
-            query_embed1 = last_hidden_state1.mean(1)  # query : [batch_size, hidden]
-            query_embed2 = last_hidden_state2.mean(1)  # query : [batch_size, hidden]
-        elif self.agg_mode == "mean":
-            query_embed1 = (last_hidden_state1 * query_toks1['attention_mask'].unsqueeze(-1)).sum(1) / query_toks1['attention_mask'].sum(-1).unsqueeze(-1)
-            query_embed2 = (last_hidden_state2 * query_toks2['attention_mask'].unsqueeze(-1)).sum(1) / query_toks2['attention_mask'].sum(-1).unsqueeze(-1)
-        else:
-            raise NotImplementedError()
+        query_embed1 = self.pool(last_hidden_state1, query_toks1['attention_mask'])  # query : [batch_size, hidden]
+        query_embed2 = self.pool(last_hidden_state2, query_toks2['attention_mask'])  # query : [batch_size, hidden]
         query_embed = torch.cat([query_embed1, query_embed2], dim=0)
         
         labels = torch.cat([labels, labels], dim=0)
@@ -82,6 +100,33 @@ class Sap_Metric_Learning(nn.Module):
             return self.loss(query_embed, labels) 
 
 
+    def pool(self, last_hidden_state, attention_mask):
+        return pool(last_hidden_state, attention_mask, self.agg_mode)
+
+    def encode_pairs_fused(self, query_toks1, query_toks2):
+        """
+        Embed both sides of the pairs with a single encoder pass: the sides are stacked into one
+        batch, and names tokenized identically (e.g. on both sides) are encoded only once
+
+        Returns
+        -------
+        query_embed : torch.Tensor
+            [2 * batch_size, hidden], the embeddings of side 1 followed by those of side 2
+        """
+        if self.agg_mode == "mean_all_tok" and query_toks1['input_ids'].shape[1] != query_toks2['input_ids'].shape[1]:
+            # padding one side further would change its mean over all tokens
+            raise ValueError("mean_all_tok needs both sides padded to the same width (max_length)")
+        toks = stack_tokenized(query_toks1, query_toks2, self.pad_token_id, self.padding_side)
+        unique_ids, inverse = torch.unique(toks['input_ids'], dim=0, return_inverse=True)
+        # any occurrence of a unique row can stand for it, since its rows are identical
+        representatives = torch.empty(len(unique_ids), dtype=torch.long, device=inverse.device)
+        representatives.scatter_(0, inverse, torch.arange(len(inverse), device=inverse.device))
+        unique_toks = {k: v[representatives] for k, v in toks.items()}
+
+        last_hidden_state = self.encoder(**unique_toks, return_dict=True).last_hidden_state
+        # indexing by inverse routes the gradients of every occurrence back to the shared row
+        return self.pool(last_hidden_state, unique_toks['attention_mask'])[inverse]
+
     def reshape_candidates_for_encoder(self, candidates):
         """
         reshape candidates for encoder input shape
@@ -113,4 +158,15 @@ class Sap_Metric_Learning(nn.Module):
         return embedding_table
 
 
+def stack_tokenized(query_toks1, query_toks2, pad_token_id=0, padding_side="right"):
+    """
+    Stack two tokenized batches into one, padding the narrower one on the tokenizer's padding side:
+    input_ids with pad_token_id, and the attention mask (and token type ids) with zeros
+    """
+    width = max(query_toks1['input_ids'].shape[1], query_toks2['input_ids'].shape[1])
+
+    def pad(k, toks):
+        padding = (width - toks[k].shape[1], 0) if padding_side == "left" else (0, width - toks[k].shape[1])
+        return F.pad(toks[k], padding, value=pad_token_id if k == 'input_ids' else 0)
 
+    return {k: torch.cat([pad(k, query_toks1), pad(k, query_toks2)], dim=0) for k in query_toks1}
@@ -0,0 +1,119 @@
+import os
+import logging
+import threading
+import torch
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ModelSnapshot():
+    """
+    Snapshot of the encoder weights, e.g. of the best model seen so far during training. The
+    state_dict is copied asynchronously into (pinned) CPU buffers, so the encoder is never
+    duplicated on the device. The weights are only loaded back into the encoder by restore
+    """
+
+    def __init__(self, snapshot_dir=None):
+        """
+        Parameters
+        ----------
+        snapshot_dir : str
+            If given, every snapshot is written to snapshot_dir/encoder.safetensors by a background
+            thread, and its CPU buffers are released once written. Otherwise the last snapshot is
+            kept in CPU memory, in buffers reused across snapshots
+        """
+        LOGGER.info("ModelSnapshot! snapshot_dir={}".format(snapshot_dir))
+        self.snapshot_dir = snapshot_dir
+        self.path = os.path.join(snapshot_dir, "encoder.safetensors") if snapshot_dir else None
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+        self.state = None  # only kept when there is no snapshot_dir
+        self.info = None
+        self.copied = None
+        self.writer = None
+
+    def take(self, encoder, **info):
+        """
+        Start copying the weights of encoder and return without waiting for the copy
+
+        Parameters
+        ----------
+        encoder : nn.Module
+            The encoder whose state_dict is copied
+        info : dict
+            Stored along with the weights, e.g. epoch and accuracy
+        """
+        # the previous snapshot must be done first (its buffers are reused, or its file replaced)
+        self.wait()
+        state_dict = encoder.state_dict()
+        if self.path is None and self.state is not None and self.state.keys() == state_dict.keys():
+            state = self.state
+        else:
+            state = {
+                name: torch.empty(
+                    tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=tensor.is_cuda
+                )
+                for name, tensor in state_dict.items()
+            }
+        for name, tensor in state_dict.items():
+            state[name].copy_(tensor.detach(), non_blocking=True)
+        self.info = info
+        self.copied = None
+        if torch.cuda.is_available():
+            self.copied = torch.cuda.Event()
+            self.copied.record()
+
+        if self.path is None:
+            self.state = state
+        else:
+            # the writer holds the only reference to the buffers, which are freed once it is done
+            self.writer = threading.Thread(target=self._write, args=(state, self.copied, info), daemon=True)
+            self.writer.start()
+        LOGGER.info("ModelSnapshot! took {}".format(info))
+
+    def _write(self, state, copied, info):
+        from safetensors.torch import save_file
+
+        if copied is not None:
+            copied.synchronize()
+        # write to a temporary file first, so a crash never leaves a partial snapshot behind
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        save_file(state, tmp_path, metadata={k: str(v) for k, v in info.items()})
+        os.replace(tmp_path, self.path)
+
+    def wait(self):
+        """
+        Block until the last snapshot is copied (and written)
+        """
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        if self.copied is not None:
+            self.copied.synchronize()
+
+    def state_dict(self):
+        """
+        The snapshot as stored in a training checkpoint. Weights written to snapshot_dir are not
+        duplicated into it
+        """
+        self.wait()
+        return {'info': self.info, 'state': self.state}
+
+    def load_state_dict(self, state_dict):
+        self.info = state_dict['info']
+        if state_dict['state'] is not None:
+            self.state = state_dict['state']
+
+    def restore(self, encoder):
+        """
+        Load the last snapshot into encoder and return its info
+        """
+        self.wait()
+        if self.path is not None:
+            from safetensors.torch import load_file
+            state = load_file(self.path)
+        else:
+            state = self.state
+        encoder.load_state_dict(state)
+        LOGGER.info("ModelSnapshot! restored {}".format(self.info))
+        return self.info
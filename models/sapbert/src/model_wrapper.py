@@ -1,6 +1,9 @@
 import os
+import queue
 import pickle
+import hashlib
 import logging
+import threading
 import torch
 import numpy as np
 import time
@@ -8,10 +11,13 @@ from tqdm import tqdm
 from torch import nn
 from sklearn.metrics.pairwise import cosine_similarity
 from .metric_learning import *
+from .metric_learning import pool
+from .mention_cache import MentionCache, normalize_mention, mention_normalization
 
 from transformers import (
     AutoTokenizer, 
     AutoModel, 
+    AutoConfig,
 )
 
 LOGGER = logging.getLogger()
@@ -25,6 +31,16 @@ class Model_Wrapper(object):
     def __init__(self):
         self.tokenizer = None
         self.encoder = None
+        self.max_length = None
+        self.device = None
+        self.quantized = False
+        self.quantized_cache_dir = None
+        self.onnx_session = None
+        self.onnx_path = None
+        self.onnx_agg_mode = None
+        self.onnx_fingerprint = None
+        self.mention_cache = None
+        self.encoder_generation = 0  # bumped by invalidate
 
     def get_dense_encoder(self):
         assert (self.encoder is not None)
@@ -36,6 +52,12 @@ class Model_Wrapper(object):
 
         return self.tokenizer
 
+    @property
+    def hidden_size(self):
+        if self.onnx_session is not None:
+            return self.onnx_session.get_outputs()[0].shape[-1]
+        return self.encoder.config.hidden_size
+
     def save_model(self, path, context=False):
         # Try to save the encoder
         try:
@@ -52,19 +74,108 @@ class Model_Wrapper(object):
         self.tokenizer.save_pretrained(path)
         
 
-    def load_model(self, path, max_length=25, use_cuda=True, lowercase=True, trust_remote_code=False):
-        self.load_bert(path, max_length, use_cuda, trust_remote_code=trust_remote_code)
+    def load_model(self, path, max_length=25, use_cuda=True, lowercase=True, trust_remote_code=False, device=None,
+                   quantize=False, quantized_cache_dir=None, onnx_path=None):
+        self.load_bert(path, max_length, use_cuda, trust_remote_code=trust_remote_code, device=device,
+                       quantize=quantize, quantized_cache_dir=quantized_cache_dir, onnx_path=onnx_path)
         
         return self
 
-    def load_bert(self, path, max_length, use_cuda, lowercase=True, trust_remote_code=False):
+    def load_bert(self, path, max_length, use_cuda, lowercase=True, trust_remote_code=False, device=None,
+                  quantize=False, quantized_cache_dir=None, onnx_path=None):
         self.tokenizer = AutoTokenizer.from_pretrained(path, 
                 use_fast=True, do_lower_case=lowercase)
-        self.encoder = AutoModel.from_pretrained(path, trust_remote_code=trust_remote_code)
-        if use_cuda:
-            self.encoder = self.encoder.cuda()
+        self.max_length = max_length
+        if onnx_path is not None:
+            # the tokenizer still comes from path, the encoder is replaced by an onnxruntime session
+            self.encoder = None
+            self.load_onnx(onnx_path)
+        elif quantize:
+            # dynamically quantized kernels only run on the CPU
+            if device is not None and torch.device(device).type != "cpu":
+                LOGGER.warning("int8 quantized encoder requested on {}, running on the CPU".format(device))
+            self.encoder = self.load_quantized_encoder(path, trust_remote_code, quantized_cache_dir)
+            self.device = torch.device("cpu")
+            self.quantized = True
+            self.quantized_cache_dir = quantized_cache_dir
+        else:
+            self.encoder = AutoModel.from_pretrained(path, trust_remote_code=trust_remote_code)
+            self.device = get_device(use_cuda=use_cuda, device=device)
+            self.encoder = self.encoder.to(self.device)
+        self.invalidate()
 
         return self.encoder, self.tokenizer
+
+    def load_onnx(self, onnx_path, num_threads=None):
+        """
+        Run the encoder as an onnxruntime CPU session of a graph written by export_onnx
+
+        Parameters
+        ----------
+        onnx_path : str
+            The .onnx file
+        num_threads : int
+            The number of intra-op threads of the session (onnxruntime picks one by default)
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.onnx_session = onnxruntime.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        from .embedding_cache import fingerprint_file
+
+        self.onnx_path = onnx_path
+        # the graph content, so re-exporting to the same path is a different encoder
+        self.onnx_fingerprint = fingerprint_file(onnx_path)
+        self.onnx_agg_mode = self.onnx_session.get_modelmeta().custom_metadata_map.get("agg_mode")
+        self.invalidate()
+        self.device = torch.device("cpu")
+        LOGGER.info("onnxruntime session! path={} agg_mode={}".format(onnx_path, self.onnx_agg_mode))
+
+    def load_quantized_encoder(self, path, trust_remote_code=False, cache_dir=None):
+        """
+        Return the encoder at path with dynamic int8 quantization applied to its linear layers.
+        If cache_dir is given, the quantized weights are cached there, keyed by the checkpoint files,
+        so a reload only builds the model skeleton and reads the int8 weights
+
+        Parameters
+        ----------
+        path : str
+            The model directory
+        cache_dir : str
+            The directory where the quantized weights are stored (the encoder is quantized on every
+            load if not given; the model directory is never written to)
+
+        Returns
+        -------
+        encoder : nn.Module
+            The quantized encoder, on the CPU and in eval mode
+        """
+        if cache_dir is None:
+            return quantize_encoder(AutoModel.from_pretrained(path, trust_remote_code=trust_remote_code))
+
+        cache_path = os.path.join(cache_dir, "encoder_int8_{}.pt".format(fingerprint_checkpoint(path)))
+        if os.path.exists(cache_path):
+            LOGGER.info("quantized encoder cache hit! path={}".format(cache_path))
+            config = AutoConfig.from_pretrained(path, trust_remote_code=trust_remote_code)
+            encoder = quantize_encoder(AutoModel.from_config(config, trust_remote_code=trust_remote_code))
+            # packed int8 params are not plain tensors, and the file was written by this method
+            encoder.load_state_dict(torch.load(cache_path, map_location="cpu", weights_only=False))
+            return encoder
+
+        LOGGER.info("quantized encoder cache miss! path={}".format(cache_path))
+        encoder = quantize_encoder(AutoModel.from_pretrained(path, trust_remote_code=trust_remote_code))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file first, so concurrent readers never see a partial file
+            tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+            torch.save(encoder.state_dict(), tmp_path)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            LOGGER.warning("could not cache the quantized encoder: {}".format(e))
+        return encoder
     
 
     def get_score_matrix(self, query_embeds, dict_embeds, cosine=False, normalise=False):
@@ -143,7 +254,7 @@ class Model_Wrapper(object):
 
         res = None
         for i in tqdm(np.arange(0, score_matrix.shape[0], batch_size), disable=not show_progress):
-            score_matrix_tmp = torch.tensor(score_matrix[i:i+batch_size]).cuda()
+            score_matrix_tmp = torch.tensor(score_matrix[i:i+batch_size]).to(self.device)
             matrix_sorted = torch.argsort(score_matrix_tmp, dim=1, descending=True)[:, :topk].cpu()
             if res is None: 
                 res = matrix_sorted
@@ -152,7 +263,131 @@ class Model_Wrapper(object):
 
         return res.numpy()
 
-    def embed_dense(self, names, show_progress=False, batch_size=4096, agg_mode="cls", description=None):
+    def retrieve_candidate_blocked(self, query_embeds, dict_embeds, topk, cosine=False, block_size=16384,
+                                   query_batch_size=1024, dict_idxs=None, dict_scales=None, show_progress=False):
+        """
+        Return sorted topk scores and idxes (descending order) without building the full score matrix.
+        The dictionary is scanned in blocks of block_size rows and a running topk is kept for every query,
+        so peak memory is bounded by query_batch_size x block_size scores
+
+        Parameters
+        ----------
+        query_embeds : np.array
+            2d numpy array of query embeddings
+        dict_embeds : np.array
+            2d numpy array of dictionary embeddings (can be a memory-mapped array)
+        topk : int
+            The number of candidates
+        cosine : bool
+            Score with cosine similarity instead of the dot product
+        block_size : int
+            The number of dictionary rows scored at once
+        query_batch_size : int
+            The number of queries scored at once
+        dict_idxs : np.array
+            Restrict the search to these dictionary rows (gathered block by block)
+        dict_scales : np.array
+            Per-row scales of quantized dictionary embeddings (the scores of row i are multiplied
+            by dict_scales[i]), see CompactEmbeddings
+
+        Returns
+        -------
+        topk_scores : np.array
+            2d numpy array of scores [# of query, topk]
+        topk_idxs : np.array
+            2d numpy array of dictionary idxes [# of query, topk]
+        """
+        query_embeds = np.asarray(query_embeds, dtype=np.float32)
+        if cosine:
+            query_embeds = _l2_normalise(query_embeds)
+        if self.device is not None and self.device.type == "cuda":
+            return self._retrieve_candidate_blocked_torch(
+                query_embeds, dict_embeds, topk, cosine, block_size, query_batch_size, dict_idxs, dict_scales,
+                show_progress
+            )
+        num_queries = query_embeds.shape[0]
+        num_dict = dict_embeds.shape[0] if dict_idxs is None else len(dict_idxs)
+        topk = min(topk, num_dict)
+
+        topk_scores = np.empty((num_queries, topk), dtype=np.float32)
+        topk_idxs = np.empty((num_queries, topk), dtype=np.int64)
+        for q_start in tqdm(range(0, num_queries, query_batch_size), disable=not show_progress):
+            q_end = min(q_start + query_batch_size, num_queries)
+            query_batch = query_embeds[q_start:q_end]
+            best_scores = np.full((q_end - q_start, 0), -np.inf, dtype=np.float32)
+            best_idxs = np.empty((q_end - q_start, 0), dtype=np.int64)
+
+            for d_start in range(0, num_dict, block_size):
+                if dict_idxs is None:
+                    block_rows = np.arange(d_start, min(d_start + block_size, num_dict))
+                    block = np.asarray(dict_embeds[d_start:d_start + block_size], dtype=np.float32)
+                else:
+                    block_rows = np.asarray(dict_idxs[d_start:d_start + block_size])
+                    block = np.asarray(dict_embeds[block_rows], dtype=np.float32)
+                if cosine:
+                    block = _l2_normalise(block)
+                block_scores = np.matmul(query_batch, block.T)
+                if dict_scales is not None and not cosine:
+                    block_scores *= dict_scales[block_rows]
+                block_idxs = np.broadcast_to(block_rows, block_scores.shape)
+
+                # merge the block with the running topk
+                best_scores = np.concatenate([best_scores, block_scores], axis=1)
+                best_idxs = np.concatenate([best_idxs, block_idxs], axis=1)
+                best_scores, best_idxs = _select_topk(best_scores, best_idxs, topk)
+
+            # sort the topk by descending score (ties broken by the lowest dictionary idx)
+            order = np.lexsort((best_idxs, -best_scores), axis=1)
+            topk_scores[q_start:q_end] = np.take_along_axis(best_scores, order, axis=1)
+            topk_idxs[q_start:q_end] = np.take_along_axis(best_idxs, order, axis=1)
+
+        return topk_scores, topk_idxs
+
+    def _retrieve_candidate_blocked_torch(self, query_embeds, dict_embeds, topk, cosine, block_size,
+                                          query_batch_size, dict_idxs, dict_scales, show_progress):
+        """
+        retrieve_candidate_blocked on an accelerator, where torch.topk beats a host-side argpartition
+        """
+        num_queries = query_embeds.shape[0]
+        num_dict = dict_embeds.shape[0] if dict_idxs is None else len(dict_idxs)
+        topk = min(topk, num_dict)
+
+        topk_scores, topk_idxs = [], []
+        for q_start in tqdm(range(0, num_queries, query_batch_size), disable=not show_progress):
+            query_batch = torch.from_numpy(query_embeds[q_start:q_start + query_batch_size]).to(self.device)
+            best_scores = torch.empty((query_batch.shape[0], 0), device=self.device)
+            best_idxs = torch.empty((query_batch.shape[0], 0), dtype=torch.int64, device=self.device)
+
+            for d_start in range(0, num_dict, block_size):
+                if dict_idxs is None:
+                    block_rows = np.arange(d_start, min(d_start + block_size, num_dict))
+                    block = np.asarray(dict_embeds[d_start:d_start + block_size], dtype=np.float32)
+                else:
+                    block_rows = np.asarray(dict_idxs[d_start:d_start + block_size])
+                    block = np.asarray(dict_embeds[block_rows], dtype=np.float32)
+                block = torch.from_numpy(block).to(self.device)
+                if cosine:
+                    block = torch.nn.functional.normalize(block, dim=1)
+                block_scores = torch.matmul(query_batch, block.T)
+                if dict_scales is not None and not cosine:
+                    block_scores *= torch.from_numpy(dict_scales[block_rows]).to(self.device)
+                block_idxs = torch.from_numpy(block_rows).to(self.device).expand_as(block_scores)
+
+                # merge the block with the running topk
+                best_scores = torch.cat([best_scores, block_scores], dim=1)
+                best_idxs = torch.cat([best_idxs, block_idxs], dim=1)
+                best_scores, best_idxs = _select_topk_torch(best_scores, best_idxs, topk)
+
+            # sort the topk by descending score (ties broken by the lowest dictionary idx)
+            best_scores, best_idxs = best_scores.cpu().numpy(), best_idxs.cpu().numpy()
+            order = np.lexsort((best_idxs, -best_scores), axis=1)
+            topk_scores.append(np.take_along_axis(best_scores, order, axis=1))
+            topk_idxs.append(np.take_along_axis(best_idxs, order, axis=1))
+
+        return np.concatenate(topk_scores, axis=0), np.concatenate(topk_idxs, axis=0)
+
+    def embed_dense(self, names, show_progress=False, batch_size=4096, agg_mode="cls", description=None,
+                    padding="longest", prefetch_batches=2, out=None, token_store=None, use_cache=True):
         """
         Embedding data into dense representations
 
@@ -160,49 +395,354 @@ class Model_Wrapper(object):
         ----------
         names : np.array
             An array of names
+        padding : str
+            "longest" sorts the names by token length and pads every batch only to its longest
+            member, "max_length" pads every name to max_length. mean_all_tok pooling averages over
+            the padding too, so it always uses "max_length"
+        prefetch_batches : int
+            The number of batches a background thread tokenizes ahead of the encoder (0 to tokenize
+            in the main thread)
+        out : np.array
+            Preallocated [# of names, hidden] array (e.g. a slice of a memory-mapped file) to write
+            the embeddings into
+        token_store : TokenStore
+            The token ids of names, tokenized beforehand with this tokenizer and max_length. Batches
+            are then padded straight from the store, without running the tokenizer
+        use_cache : bool
+            Whether to go through the mention cache (if enabled). Dictionaries and benchmarks bypass
+            it, so they neither fill it nor measure its hits
 
         Returns
         -------
-        dense_embeds : list
-            A list of dense embeddings
+        dense_embeds : np.array
+            2d numpy array of dense embeddings, in the order of names
         """
-        self.encoder.eval() # prevent dropout
-        
-        batch_size=batch_size
-        dense_embeds = []
+        if token_store is not None:
+            if len(token_store) != len(names):
+                raise ValueError("the token store holds {} names, not {}".format(len(token_store), len(names)))
+            return self._embed_dense(names, show_progress, batch_size, agg_mode, description, padding,
+                                     prefetch_batches, out, token_store)
+        if self.mention_cache is not None and use_cache:
+            return self._embed_dense_cached(names, show_progress, batch_size, agg_mode, description, padding,
+                                            prefetch_batches, out)
+        return self._embed_dense(names, show_progress, batch_size, agg_mode, description, padding,
+                                 prefetch_batches, out)
+
+    def enable_mention_cache(self, max_size=100000):
+        """
+        Cache the embeddings of up to max_size distinct mentions across embed_dense calls (0 disables the cache)
+        """
+        self.mention_cache = MentionCache(max_size) if max_size else None
+        return self.mention_cache
+
+    def invalidate(self):
+        """
+        Mark the encoder as changed, so the embeddings cached for it are dropped. Loading a model
+        does it; call it after changing the weights in place (training steps, load_state_dict)
+        """
+        self.encoder_generation += 1
+
+    def encoder_fingerprint(self):
+        """
+        Cheap fingerprint of the encoder state, without hashing the weights: the ONNX graph content
+        or the generation of the PyTorch encoder (see invalidate)
+        """
+        if self.onnx_session is not None:
+            return (self.onnx_fingerprint, self.encoder_generation, self.max_length)
+        return (self.encoder_generation, self.max_length)
+
+    def _embed_dense_cached(self, names, show_progress, batch_size, agg_mode, description, padding,
+                            prefetch_batches, out):
+        """
+        embed_dense through the mention cache: every distinct uncached mention is encoded once
+        """
+        cache = self.mention_cache
+        fingerprint = self.encoder_fingerprint()
+        if fingerprint != cache.fingerprint:
+            self._mention_normalization = mention_normalization(self.tokenizer)
+        cache.check_fingerprint(fingerprint)
+        squeeze_whitespace, lowercase = self._mention_normalization
+
+        dense_embeds = np.empty((len(names), self.hidden_size), dtype=np.float32) if out is None else out
+        keys = [(agg_mode, normalize_mention(name, squeeze_whitespace, lowercase)) for name in names]
+        missing = {}  # key -> position of the first occurrence
+        for i, key in enumerate(keys):
+            embed = cache.get(key)
+            if embed is not None:
+                dense_embeds[i] = embed
+            elif key not in missing:
+                missing[key] = i
+        cache.misses += len(missing)
+        cache.hits += len(names) - len(missing)
+        if not missing:
+            return dense_embeds
+
+        missing_embeds = self._embed_dense(
+            [names[i] for i in missing.values()], show_progress, batch_size, agg_mode, description, padding,
+            prefetch_batches, None
+        )
+        missing_rows = {}
+        for row, key in enumerate(missing):
+            cache.put(key, missing_embeds[row].copy())
+            missing_rows[key] = row
+        for i, key in enumerate(keys):
+            if key in missing_rows:
+                dense_embeds[i] = missing_embeds[missing_rows[key]]
+        return dense_embeds
+
+    def _embed_dense(self, names, show_progress, batch_size, agg_mode, description, padding, prefetch_batches, out,
+                     token_store=None):
+        if self.onnx_session is not None:
+            # the pooling is part of the exported graph
+            if agg_mode != self.onnx_agg_mode:
+                raise ValueError("the ONNX encoder was exported with agg_mode={}, not {}".format(self.onnx_agg_mode, agg_mode))
+            onnx_input_names = {onnx_input.name for onnx_input in self.onnx_session.get_inputs()}
+        else:
+            self.encoder.eval() # prevent dropout
+        if agg_mode == "mean_all_tok":
+            padding = "max_length"
 
-        #print ("converting names to list...")
-        #names = names.tolist()
+        if out is None:
+            dense_embeds = np.empty((len(names), self.hidden_size), dtype=np.float32)
+        else:
+            dense_embeds = out
+        if len(names) == 0:
+            return dense_embeds
 
-        with torch.no_grad():
+        with torch.inference_mode():
+            iterations = _prefetch(self._iter_batches(names, batch_size, padding, token_store=token_store), prefetch_batches)
             if show_progress:
-                iterations = tqdm(range(0, len(names), batch_size), desc=description)
-            else:
-                iterations = range(0, len(names), batch_size)
-                
-            for start in iterations:
-                end = min(start + batch_size, len(names))
-                batch = names[start:end]
-                batch_tokenized_names = self.tokenizer.batch_encode_plus(
-                        batch, add_special_tokens=True, 
-                        truncation=True, max_length=25, 
-                        padding="max_length", return_tensors='pt')
+                iterations = tqdm(iterations, total=(len(names) + batch_size - 1) // batch_size, desc=description)
+
+            for positions, batch_tokenized_names in iterations:
+                if self.onnx_session is not None:
+                    dense_embeds[positions] = self.onnx_session.run(None, {
+                        k: v.numpy() for k, v in batch_tokenized_names.items() if k in onnx_input_names
+                    })[0]
+                    continue
+
                 batch_tokenized_names_cuda = {}
                 for k,v in batch_tokenized_names.items(): 
-                    batch_tokenized_names_cuda[k] = v.cuda()
+                    batch_tokenized_names_cuda[k] = v.to(self.device, non_blocking=True)
                 
                 last_hidden_state = self.encoder(**batch_tokenized_names_cuda)[0]
-                if agg_mode == "cls":
-                    batch_dense_embeds = last_hidden_state[:,0,:] # [CLS]
-                elif agg_mode == "mean_all_tok":
-                    batch_dense_embeds = last_hidden_state.mean(1) # pooling
-                elif agg_mode == "mean":
-                    batch_dense_embeds = (last_hidden_state * batch_tokenized_names_cuda['attention_mask'].unsqueeze(-1)).sum(1) / batch_tokenized_names_cuda['attention_mask'].sum(-1).unsqueeze(-1)
-                else:
-                    print ("no such agg_mode:", agg_mode)
-
-                batch_dense_embeds = batch_dense_embeds.cpu().detach().numpy()
-                dense_embeds.append(batch_dense_embeds)
-        dense_embeds = np.concatenate(dense_embeds, axis=0)
+                batch_dense_embeds = pool(last_hidden_state, batch_tokenized_names_cuda['attention_mask'], agg_mode)
+                dense_embeds[positions] = batch_dense_embeds.float().cpu().numpy()
         
         return dense_embeds
+
+    def _iter_batches(self, names, batch_size, padding, window_batches=8, token_store=None):
+        """
+        Yield (positions in names, tokenized batch) pairs. With "longest" padding, names are
+        tokenized window_batches batches at a time and bucketed by token length within the window,
+        so tokenization of the next window can overlap with encoding of the current one. With a
+        token_store, batches are only padded (and bucketed by length over all the names)
+        """
+        max_length = self.max_length or 25
+        pin_memory = self.device is not None and self.device.type == "cuda"
+        if token_store is not None:
+            lengths = np.asarray(token_store.lengths)
+            order = np.arange(len(lengths)) if padding == "max_length" else np.argsort(lengths, kind="stable")
+            for start in range(0, len(order), batch_size):
+                positions = order[start:start + batch_size]
+                batch_tokenized_names = self.pad_batch(
+                    [token_store[i] for i in positions], length=max_length if padding == "max_length" else None
+                )
+                yield positions, _pin(batch_tokenized_names, pin_memory)
+        elif padding == "max_length":
+            for start in range(0, len(names), batch_size):
+                end = min(start + batch_size, len(names))
+                batch_tokenized_names = self.tokenizer.batch_encode_plus(
+                        list(names[start:end]), add_special_tokens=True, 
+                        truncation=True, max_length=max_length, 
+                        padding="max_length", return_tensors='pt')
+                yield np.arange(start, end), _pin(batch_tokenized_names, pin_memory)
+        else:
+            window_size = batch_size * window_batches
+            for window_start in range(0, len(names), window_size):
+                # tokenize without padding, and bucket the names by token length
+                token_ids = self.tokenizer(
+                    list(names[window_start:window_start + window_size]),
+                    add_special_tokens=True, truncation=True, max_length=max_length
+                )['input_ids']
+                order = np.argsort([len(ids) for ids in token_ids], kind="stable")
+                for start in range(0, len(order), batch_size):
+                    positions = order[start:start + batch_size]
+                    batch_tokenized_names = self.pad_batch([token_ids[i] for i in positions])
+                    yield window_start + positions, _pin(batch_tokenized_names, pin_memory)
+
+    def pad_batch(self, token_ids, length=None):
+        """
+        Pad a batch of token id sequences to its longest member
+
+        Parameters
+        ----------
+        token_ids : list
+            A list of token id sequences
+        length : int
+            Pad to this length instead (at least the longest member)
+
+        Returns
+        -------
+        batch : dict
+            input_ids and attention_mask (and token_type_ids if the encoder takes them) tensors
+        """
+        lengths = np.array([len(ids) for ids in token_ids])
+        input_ids = np.full((len(token_ids), max(lengths.max(), length or 0)), self.tokenizer.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros(input_ids.shape, dtype=np.int64)
+        for i, ids in enumerate(token_ids):
+            if self.tokenizer.padding_side == "left":
+                input_ids[i, input_ids.shape[1] - len(ids):] = ids
+                attention_mask[i, input_ids.shape[1] - len(ids):] = 1
+            else:
+                input_ids[i, :len(ids)] = ids
+                attention_mask[i, :len(ids)] = 1
+
+        batch = {'input_ids': torch.from_numpy(input_ids), 'attention_mask': torch.from_numpy(attention_mask)}
+        if "token_type_ids" in self.tokenizer.model_input_names:
+            batch['token_type_ids'] = torch.zeros_like(batch['input_ids'])
+        return batch
+
+
+def _pin(batch, pin_memory):
+    """
+    Page-lock the tensors of a tokenized batch, so they can be copied to the GPU asynchronously
+    """
+    if not pin_memory:
+        return batch
+    return {k: v.pin_memory() for k, v in batch.items()}
+
+
+def _prefetch(iterator, depth):
+    """
+    Run iterator in a background thread that keeps up to depth items ready in a bounded queue
+    """
+    if depth <= 0:
+        yield from iterator
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+    errors = []
+
+    def put(item):
+        # give up as soon as the consumer stops
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+        except Exception as e:
+            errors.append(e)
+        put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        # let the producer exit even if the consumer stopped early
+        stop.set()
+        producer.join()
+    if errors:
+        raise errors[0]
+
+
+def quantize_encoder(encoder):
+    """
+    Apply dynamic int8 quantization to the linear layers of an encoder: weights are stored as int8
+    and activations are quantized on the fly, batch by batch
+    """
+    encoder = encoder.to("cpu").eval()
+    return torch.quantization.quantize_dynamic(encoder, {nn.Linear}, dtype=torch.qint8)
+
+
+def fingerprint_checkpoint(path):
+    """
+    Cheap hash of a model directory: the name, size and modification time of its files
+    """
+    sha = hashlib.sha1(torch.__version__.encode("utf-8"))
+    for name in sorted(os.listdir(path)):
+        stat = os.stat(os.path.join(path, name))
+        sha.update("{}|{}|{}".format(name, stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    return sha.hexdigest()[:16]
+
+
+def get_device(use_cuda=True, device=None):
+    """
+    Resolve the device to run on: an explicit device wins, otherwise CUDA if it was
+    requested and is available, and the CPU in any other case
+    """
+    if device is not None:
+        return torch.device(device)
+    if use_cuda and torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def set_num_threads(num_threads=None, num_interop_threads=None):
+    """
+    Configure the intra-op and inter-op thread pools used by torch on the CPU.
+    The inter-op pool can only be sized before any parallel work has started
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            LOGGER.warning("could not set the number of inter-op threads: {}".format(e))
+
+
+def _l2_normalise(embeds):
+    """
+    Scale every row to unit length (rows of zeros are left untouched, as in sklearn)
+    """
+    norms = np.linalg.norm(embeds, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeds / norms
+
+
+def _select_topk(scores, idxs, topk):
+    """
+    Keep the topk (unsorted) scores of every row, along with their idxes. Among the scores tied
+    with the k-th best one, the lowest idxes are kept, so the selection does not depend on topk or
+    on how the dictionary was split into blocks
+    """
+    if scores.shape[1] <= topk:
+        return scores, idxs
+    part = np.argpartition(-scores, topk - 1, axis=1)[:, :topk]
+    kth = np.take_along_axis(scores, part, axis=1).min(1, keepdims=True)
+    # argpartition keeps an arbitrary subset of a tie band that straddles the k-th slot
+    for row in np.flatnonzero((scores >= kth).sum(1) > topk):
+        part[row] = np.lexsort((idxs[row], -scores[row]))[:topk]
+    return np.take_along_axis(scores, part, axis=1), np.take_along_axis(idxs, part, axis=1)
+
+
+def _select_topk_torch(scores, idxs, topk):
+    """
+    _select_topk on torch tensors, returned sorted by descending score
+    """
+    topk = min(topk, scores.shape[1])
+    best_scores, best_pos = torch.topk(scores, topk, dim=1)
+    kth = best_scores[:, -1:]
+    # torch.topk keeps an arbitrary subset of a tie band that straddles the k-th slot
+    for row in torch.nonzero((scores >= kth).sum(1) > topk).flatten().tolist():
+        by_idx = torch.argsort(idxs[row])
+        by_score = torch.sort(-scores[row][by_idx], stable=True).indices
+        best_pos[row] = by_idx[by_score][:topk]
+        best_scores[row] = scores[row][best_pos[row]]
+    return best_scores, torch.gather(idxs, 1, best_pos)
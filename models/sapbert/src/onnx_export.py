@@ -0,0 +1,75 @@
+import logging
+import torch
+from torch import nn
+
+from .metric_learning import pool
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PooledEncoder(nn.Module):
+    """
+    Encoder followed by the agg_mode pooling, so a single graph maps token ids to name embeddings
+    """
+
+    def __init__(self, encoder, agg_mode="cls"):
+        super(PooledEncoder, self).__init__()
+        self.encoder = encoder
+        self.agg_mode = agg_mode
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None):
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if token_type_ids is not None:
+            inputs['token_type_ids'] = token_type_ids
+        last_hidden_state = self.encoder(**inputs)[0]
+        return pool(last_hidden_state, attention_mask, self.agg_mode)
+
+
+def export_onnx(model_wrapper, output_path, agg_mode="cls", opset_version=14):
+    """
+    Export the encoder of model_wrapper, with the agg_mode pooling baked in, to an ONNX graph whose
+    batch and sequence axes are dynamic. agg_mode and max_length are stored in the model metadata,
+    where Model_Wrapper.load_onnx reads them back
+
+    Parameters
+    ----------
+    model_wrapper : Model_Wrapper
+        A wrapper holding a PyTorch encoder
+    output_path : str
+        The .onnx file to write
+    agg_mode : str
+        "cls", "mean" or "mean_all_tok"
+    """
+    import onnx
+
+    LOGGER.info("export_onnx! output_path={} agg_mode={}".format(output_path, agg_mode))
+    tokenizer = model_wrapper.get_dense_tokenizer()
+    input_names = ['input_ids', 'attention_mask']
+    if "token_type_ids" in tokenizer.model_input_names:
+        input_names.append('token_type_ids')
+    sample = tokenizer(
+        ["sample name", "another sample name"], padding="max_length", truncation=True,
+        max_length=model_wrapper.max_length or 25, return_tensors="pt"
+    )
+
+    pooled_encoder = PooledEncoder(model_wrapper.get_dense_encoder(), agg_mode).to("cpu").eval()
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['embeddings'] = {0: 'batch'}
+    # no_grad rather than inference_mode: the tracer cannot record inference tensors
+    with torch.no_grad():
+        torch.onnx.export(
+            pooled_encoder,
+            tuple(sample[name] for name in input_names),
+            output_path,
+            input_names=input_names,
+            output_names=['embeddings'],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+    model_wrapper.encoder.to(model_wrapper.device)
+
+    onnx_model = onnx.load(output_path)
+    onnx.helper.set_model_props(onnx_model, {'agg_mode': agg_mode, 'max_length': str(model_wrapper.max_length)})
+    onnx.save(onnx_model, output_path)
+    return output_path
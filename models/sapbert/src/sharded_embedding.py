@@ -0,0 +1,102 @@
+import os
+import shutil
+import logging
+import tempfile
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .model_wrapper import Model_Wrapper, set_num_threads
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _embed_shard(model_dir, names, output_path, start, num_threads, max_length, agg_mode, batch_size, quantize=False,
+                 onnx_path=None, quantized_cache_dir=None, token_store=None):
+    """
+    Worker: load a CPU copy of the encoder and embed one shard straight into the shared output file
+    """
+    set_num_threads(num_threads, 1)
+    model_wrapper = Model_Wrapper().load_model(
+        path=model_dir, max_length=max_length, use_cuda=False, device="cpu", quantize=quantize, onnx_path=onnx_path,
+        quantized_cache_dir=quantized_cache_dir
+    )
+    dense_embeds = np.load(output_path, mmap_mode="r+")
+    model_wrapper.embed_dense(
+        names=names, batch_size=batch_size, agg_mode=agg_mode, out=dense_embeds[start:start + len(names)],
+        token_store=token_store
+    )
+    dense_embeds.flush()
+    return start, len(names)
+
+
+def embed_dense_sharded(model_wrapper, names, output_path, num_workers, threads_per_worker=None, model_dir=None,
+                        batch_size=4096, agg_mode="cls", token_store=None):
+    """
+    Embed names with num_workers CPU processes, each holding its own encoder copy and writing its
+    contiguous shard of rows into a shared memory-mapped .npy file
+
+    Parameters
+    ----------
+    model_wrapper : Model_Wrapper
+        The model to embed with
+    names : list
+        A list of names
+    output_path : str
+        The .npy file the embeddings are written to
+    num_workers : int
+        The number of worker processes
+    threads_per_worker : int
+        The number of intra-op threads of every worker (defaults to an even split of the cores)
+    model_dir : str
+        A directory or Huggingface ID holding the same weights as model_wrapper, for the workers to
+        load. If not given, model_wrapper is saved to a temporary directory first (which an int8
+        quantized model_wrapper does not support)
+    token_store : TokenStore
+        The token ids of names; every worker only receives the ids of its shard
+
+    Returns
+    -------
+    dense_embeds : np.memmap
+        A read-only memory-mapped array of dense embeddings
+    """
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+    LOGGER.info("embed_dense_sharded! # of names={} num_workers={} threads_per_worker={}".format(
+        len(names), num_workers, threads_per_worker
+    ))
+
+    dense_embeds = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype=np.float32, shape=(len(names), model_wrapper.hidden_size)
+    )
+    del dense_embeds
+
+    tmp_model_dir = None
+    if model_dir is None and (model_wrapper.quantized or model_wrapper.onnx_path is not None):
+        raise ValueError("embed_dense_sharded needs the model_dir of a quantized or ONNX model")
+    if model_dir is None:
+        tmp_model_dir = tempfile.mkdtemp()
+        model_wrapper.save_model(tmp_model_dir)
+        model_dir = tmp_model_dir
+
+    try:
+        bounds = np.linspace(0, len(names), num_workers + 1).astype(int)
+        # spawn, so workers never inherit a forked copy of the parent's torch thread pools
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+            futures = [
+                executor.submit(
+                    _embed_shard, model_dir, list(names[start:end]), output_path, start, threads_per_worker,
+                    model_wrapper.max_length, agg_mode, batch_size, model_wrapper.quantized,
+                    model_wrapper.onnx_path, model_wrapper.quantized_cache_dir,
+                    token_store.slice(start, end) if token_store is not None else None
+                )
+                for start, end in zip(bounds[:-1], bounds[1:]) if end > start
+            ]
+            for future in futures:
+                start, num_rows = future.result()
+                LOGGER.info("embed_dense_sharded! rows {}-{} done".format(start, start + num_rows))
+    finally:
+        if tmp_model_dir is not None:
+            shutil.rmtree(tmp_model_dir)
+
+    return np.load(output_path, mmap_mode="r")
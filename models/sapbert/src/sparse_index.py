@@ -0,0 +1,64 @@
+import logging
+import numpy as np
+from tqdm import tqdm
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SparseIndex():
+    """
+    TF-IDF character n-gram index over dictionary names, stored as a scipy sparse matrix. Rows are
+    L2-normalized, so a query scores every name with the cosine similarity of their n-gram vectors
+    """
+
+    def __init__(self, names, ngram_range=(2, 3)):
+        """
+        Parameters
+        ----------
+        names : list
+            The dictionary names
+        ngram_range : tuple
+            The smallest and largest character n-gram sizes (n-grams do not cross word boundaries)
+        """
+        LOGGER.info("SparseIndex! # of dict={} ngram_range={}".format(len(names), ngram_range))
+        self.vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=ngram_range, lowercase=True, dtype=np.float32)
+        # [vocab, # of dict], so a block of queries is scored with a single sparse product
+        self.matrix_t = self.vectorizer.fit_transform(names).T.tocsr()
+
+    def search(self, texts, topk, batch_size=64, show_progress=False):
+        """
+        Return sorted topk scores and idxes (descending order)
+
+        Parameters
+        ----------
+        texts : list
+            The query texts
+        topk : int
+            The number of candidates
+        batch_size : int
+            The number of queries scored at once (each block is densified to [batch_size, # of dict])
+
+        Returns
+        -------
+        topk_scores : np.array
+            2d numpy array of cosine similarities [# of query, topk]
+        topk_idxs : np.array
+            2d numpy array of dictionary idxes [# of query, topk], padded with -1 if fewer than
+            topk names share an n-gram with the query
+        """
+        queries = self.vectorizer.transform(texts).tocsr()
+        num_dict = self.matrix_t.shape[1]
+        topk = min(topk, num_dict)
+        topk_scores = np.empty((len(texts), topk), dtype=np.float32)
+        topk_idxs = np.empty((len(texts), topk), dtype=np.int64)
+        for start in tqdm(range(0, len(texts), batch_size), disable=not show_progress, desc="- Sparse search"):
+            scores = (queries[start:start + batch_size] @ self.matrix_t).toarray()
+            idxs = np.argpartition(-scores, topk - 1, axis=1)[:, :topk] if topk < num_dict else np.tile(np.arange(num_dict), (len(scores), 1))
+            scores = np.take_along_axis(scores, idxs, axis=1)
+            order = np.argsort(-scores, axis=1, kind="stable")
+            scores, idxs = np.take_along_axis(scores, order, axis=1), np.take_along_axis(idxs, order, axis=1)
+            idxs[scores <= 0] = -1
+            topk_scores[start:start + batch_size] = scores
+            topk_idxs[start:start + batch_size] = idxs
+        return topk_scores, topk_idxs
@@ -0,0 +1,91 @@
+import os
+import hashlib
+import logging
+import numpy as np
+
+from .embedding_cache import fingerprint_tokenizer, fingerprint_names
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TokenStore():
+    """
+    Token ids of a list of names, tokenized once and stored compactly: all ids concatenated in a
+    flat int32 array, with the int32 length of every name. Stored as .npy files next to the
+    dictionary and memory-mapped when loaded
+    """
+
+    def __init__(self, ids, lengths):
+        self.ids = ids
+        self.lengths = lengths
+        self.offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def slice(self, start, end):
+        """
+        Return the store of names [start, end), e.g. for a shard
+        """
+        return TokenStore(np.asarray(self.ids[self.offsets[start]:self.offsets[end]]), np.asarray(self.lengths[start:end]))
+
+    @classmethod
+    def build(cls, tokenizer, names, max_length, batch_size=65536):
+        """
+        Tokenize names (with special tokens, truncated to max_length)
+        """
+        ids, lengths = [], []
+        for start in range(0, len(names), batch_size):
+            token_ids = tokenizer(
+                list(names[start:start + batch_size]), add_special_tokens=True, truncation=True, max_length=max_length
+            )['input_ids']
+            lengths.append(np.array([len(name_ids) for name_ids in token_ids], dtype=np.int32))
+            ids.append(np.fromiter((i for name_ids in token_ids for i in name_ids), dtype=np.int32, count=int(lengths[-1].sum())))
+        if not lengths:
+            return cls(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        return cls(np.concatenate(ids), np.concatenate(lengths))
+
+    @staticmethod
+    def path(dictionary_path, tokenizer, max_length, names):
+        """
+        Path prefix of the store of a dictionary, keyed by the tokenizer, max_length and the names
+        """
+        key = hashlib.sha1("{}|{}|{}".format(
+            fingerprint_tokenizer(tokenizer), max_length, fingerprint_names(names)
+        ).encode("utf-8")).hexdigest()[:16]
+        return "{}.tokens.{}".format(dictionary_path, key)
+
+    @classmethod
+    def load_or_build(cls, dictionary_path, tokenizer, max_length, names):
+        """
+        Return the store of the names of a dictionary file, tokenizing and saving it on first use
+
+        Parameters
+        ----------
+        dictionary_path : str
+            The dictionary file, next to which the store is saved
+        tokenizer : PreTrainedTokenizer
+            The tokenizer of the model
+        max_length : int
+            The length names are truncated to
+        names : list
+            The names of the dictionary, in order
+        """
+        prefix = cls.path(dictionary_path, tokenizer, max_length, names)
+        ids_path, lengths_path = prefix + ".ids.npy", prefix + ".lengths.npy"
+        if os.path.exists(ids_path) and os.path.exists(lengths_path):
+            LOGGER.info("TokenStore hit! path={}".format(prefix))
+            return cls(np.load(ids_path, mmap_mode="r"), np.load(lengths_path))
+
+        LOGGER.info("TokenStore miss! path={}".format(prefix))
+        store = cls.build(tokenizer, names, max_length)
+        # write to temporary files first, so concurrent readers never see a partial store
+        for path, array in [(ids_path, store.ids), (lengths_path, store.lengths)]:
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+        return store
@@ -0,0 +1,115 @@
+import os
+import re
+import glob
+import random
+import logging
+import torch
+import numpy as np
+from torch.utils.data import Sampler
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Random sampler whose order is a function of (seed, epoch) only, so a resumed run draws the same
+    permutation as the interrupted one and can skip the samples that were already trained on
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """
+        Parameters
+        ----------
+        epoch : int
+            The epoch whose permutation is drawn
+        start : int
+            The number of samples of that permutation to skip
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed * 1000003 + self.epoch)
+        return iter(torch.randperm(len(self.data_source), generator=generator)[self.start:].tolist())
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class TrainingCheckpointer():
+    """
+    Writes training checkpoints as checkpoint_{global_step}.pt files in a directory, and finds the
+    latest one to resume from. Unless keep_all is set, only the latest checkpoint is kept
+    """
+
+    def __init__(self, checkpoint_dir, keep_all=False):
+        """
+        Parameters
+        ----------
+        checkpoint_dir : str
+            The directory where the checkpoints are written
+        keep_all : bool
+            Keep every checkpoint instead of deleting the previous one once a new one is written
+        """
+        LOGGER.info("TrainingCheckpointer! checkpoint_dir={} keep_all={}".format(checkpoint_dir, keep_all))
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_all = keep_all
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+    def checkpoints(self):
+        """
+        Return the (global_step, path) of every checkpoint, sorted by global_step
+        """
+        checkpoints = []
+        for path in glob.glob(os.path.join(self.checkpoint_dir, "checkpoint_*.pt")):
+            match = re.fullmatch(r"checkpoint_(\d+)\.pt", os.path.basename(path))
+            if match:
+                checkpoints.append((int(match.group(1)), path))
+        return sorted(checkpoints)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1][1] if checkpoints else None
+
+    def save(self, state, global_step):
+        path = os.path.join(self.checkpoint_dir, "checkpoint_{}.pt".format(global_step))
+        # write to a temporary file first, so a preempted run never leaves a partial checkpoint behind
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        if not self.keep_all:
+            for step, old_path in self.checkpoints():
+                if step != global_step:
+                    os.remove(old_path)
+        LOGGER.info("TrainingCheckpointer! saved {}".format(path))
+        return path
+
+    def load(self, path):
+        LOGGER.info("TrainingCheckpointer! loading {}".format(path))
+        return torch.load(path, map_location="cpu", weights_only=False)
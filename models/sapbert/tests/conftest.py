@@ -0,0 +1,40 @@
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + list("abcdefghijklmnopqrstuvwxyz") + [
+    "dolor", "fiebre", "tos", "cefalea", "agudo", "cronico", "toracico", "##s", "##a",
+]
+
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tmp_path_factory):
+    """
+    A randomly initialized one-layer BERT and its tokenizer, saved like a checkpoint
+    """
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    model_dir = str(tmp_path_factory.mktemp("tiny_bert"))
+    vocab_path = os.path.join(model_dir, "vocab.txt")
+    with open(vocab_path, "w") as f:
+        f.write("\n".join(VOCAB) + "\n")
+    tokenizer = transformers.BertTokenizerFast(vocab_file=vocab_path, do_lower_case=True)
+    torch.manual_seed(0)
+    config = transformers.BertConfig(
+        vocab_size=len(VOCAB), hidden_size=32, num_hidden_layers=1, num_attention_heads=2,
+        intermediate_size=64, max_position_embeddings=64,
+    )
+    transformers.BertModel(config).eval().save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    return model_dir
+
+
+@pytest.fixture
+def model_wrapper(tiny_model_dir):
+    from src.model_wrapper import Model_Wrapper
+
+    return Model_Wrapper().load_model(path=tiny_model_dir, max_length=16, use_cuda=False, device="cpu")
@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from src.embedding_cache import fingerprint_model, fingerprint_tokenizer
+
+NAMES = ["dolor toracico", "fiebre", "tos cronica", "cefalea"]
+
+
+def test_tokenizer_fingerprint_ignores_padding_and_truncation_state(model_wrapper):
+    tokenizer = model_wrapper.get_dense_tokenizer()
+    fresh = fingerprint_tokenizer(tokenizer)
+    fresh_model = fingerprint_model(model_wrapper, "cls")
+
+    model_wrapper.embed_dense(names=NAMES, agg_mode="cls", padding="max_length")
+    assert fingerprint_tokenizer(tokenizer) == fresh
+    assert fingerprint_model(model_wrapper, "cls") == fresh_model
+
+    model_wrapper.embed_dense(names=NAMES, agg_mode="cls")
+    assert fingerprint_tokenizer(tokenizer) == fresh
+    assert fingerprint_model(model_wrapper, "cls") == fresh_model
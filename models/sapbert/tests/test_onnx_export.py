@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from src.model_wrapper import Model_Wrapper
+from src.onnx_export import export_onnx
+
+NAMES = ["dolor toracico agudo", "fiebre", "tos cronica", "cefalea", "dolor"]
+
+
+@pytest.mark.parametrize("agg_mode", ["cls", "mean"])
+def test_onnx_embeddings_match_torch(model_wrapper, tiny_model_dir, tmp_path, agg_mode):
+    onnx_path = str(tmp_path / "encoder.onnx")
+    export_onnx(model_wrapper, onnx_path, agg_mode=agg_mode)
+    torch_embeds = model_wrapper.embed_dense(names=NAMES, agg_mode=agg_mode, use_cache=False)
+
+    onnx_wrapper = Model_Wrapper().load_model(
+        path=tiny_model_dir, max_length=16, use_cuda=False, device="cpu", onnx_path=onnx_path
+    )
+    onnx_embeds = onnx_wrapper.embed_dense(names=NAMES, agg_mode=agg_mode, use_cache=False)
+
+    assert onnx_embeds.shape == torch_embeds.shape
+    np.testing.assert_allclose(onnx_embeds, torch_embeds, atol=1e-4)
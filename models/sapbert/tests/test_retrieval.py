@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from src.model_wrapper import Model_Wrapper
+
+
+@pytest.mark.parametrize("topk,block_size", [(1, 7), (5, 13), (10, 64), (3, 1000)])
+def test_blocked_search_breaks_ties_by_lowest_idx(topk, block_size):
+    rng = np.random.default_rng(0)
+    # every dictionary row is duplicated, so most scores are tied
+    dict_embeds = np.repeat(rng.integers(0, 3, (50, 4)).astype(np.float32), 5, axis=0)
+    query_embeds = rng.integers(0, 3, (20, 4)).astype(np.float32)
+
+    _, idxs = Model_Wrapper().retrieve_candidate_blocked(
+        query_embeds, dict_embeds, topk=topk, block_size=block_size, query_batch_size=8
+    )
+
+    scores = query_embeds @ dict_embeds.T
+    all_idxs = np.broadcast_to(np.arange(len(dict_embeds)), scores.shape)
+    expected = np.lexsort((all_idxs, -scores), axis=1)[:, :topk]
+    np.testing.assert_array_equal(idxs, expected)
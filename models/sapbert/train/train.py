@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import time
-import copy
 import json
 import torch
 import logging
@@ -19,7 +18,10 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 from src.model_wrapper import Model_Wrapper
 from evaluation.utils import predict_and_evaluate
 from src.metric_learning import Sap_Metric_Learning
-from src.data_loader import MetricLearningDataset, MetricLearningDataset_pairwise, DictionaryDataset, QueryDataset_custom
+from src.data_loader import MetricLearningDataset, MetricLearningDataset_pairwise, MetricLearningDataset_grouped, DictionaryDataset, QueryDataset_custom
+from src.token_store import TokenStore
+from src.model_snapshot import ModelSnapshot
+from src.training_checkpoint import ResumableRandomSampler, TrainingCheckpointer, get_rng_state, set_rng_state
 
 LOGGER = logging.getLogger()
 
@@ -36,10 +38,19 @@ def parse_args():
                         help='Path with dictionary file woth only the test codes')
     parser.add_argument('--output_dir_for_best_model', type=str,
                         help='Directory in which the best model will be saved')
+    parser.add_argument('--best_model_snapshot_dir', type=str,
+                        help='Directory in which the weights of the best model are written (safetensors) while '
+                             'training, instead of keeping them in CPU memory (default: checkpoint_dir/best_model '
+                             'with --checkpoint_dir)')
     parser.add_argument('--results_file_path', type=str, required=True, help='Path for the file with all results')
 
     # Tokenizer settings
     parser.add_argument('--max_length', default=25, type=int)
+    parser.add_argument('--pretokenize_dictionary', action="store_true",
+                        help='tokenize the complete dictionary once and store the token ids next to it')
+    parser.add_argument('--pretokenize', action="store_true",
+                        help='tokenize the unique training names once, store the token ids next to the training file '
+                             'and collate batches by slicing them')
 
     # Train config
     parser.add_argument('--use_cuda', action="store_true")
@@ -47,17 +58,28 @@ def parse_args():
     parser.add_argument('--weight_decay', help='weight decay', default=0.01, type=float)
     parser.add_argument('--train_batch_size', help='train batch size', default=240, type=int)
     parser.add_argument('--epoch', help='epoch to train', default=3, type=int)
-    parser.add_argument('--save_checkpoint_all', action="store_true")
-    parser.add_argument('--checkpoint_step', type=int, default=10000000)
+    parser.add_argument('--save_checkpoint_all', action="store_true",
+                        help='keep every training checkpoint instead of only the latest one')
+    parser.add_argument('--checkpoint_step', type=int, default=10000000,
+                        help='optimizer steps between training checkpoints (one is also written after every epoch)')
+    parser.add_argument('--checkpoint_dir', type=str,
+                        help='Directory in which training checkpoints (weights, optimizer, scaler, data position and '
+                             'RNG states) are written')
+    parser.add_argument('--resume', action="store_true", help='resume from the latest checkpoint in --checkpoint_dir')
     parser.add_argument('--amp', action="store_true", help="automatic mixed precision training")
     parser.add_argument('--parallel', action="store_true")
     parser.add_argument('--pairwise', action="store_true", help="if loading pairwise formatted datasets")
+    parser.add_argument('--grouped', action="store_true",
+                        help="if loading a code-grouped training file (code||name lines), sampling positive pairs every epoch")
+    parser.add_argument('--pairs_per_name', default=1, type=int, help="pairs sampled per name and epoch with --grouped")
     parser.add_argument('--random_seed', help='epoch to train', default=1996, type=int)
     parser.add_argument('--loss', help="{ms_loss|cosine_loss|circle_loss|triplet_loss}}", default="ms_loss")
     parser.add_argument('--use_miner', action="store_true")
     parser.add_argument('--miner_margin', default=0.2, type=float)
     parser.add_argument('--type_of_triplets', default="all", type=str)
     parser.add_argument('--agg_mode', default="cls", type=str, help="{cls|mean|mean_all_tok}")
+    parser.add_argument('--fused_forward', action="store_true",
+                        help="encode both sides of the pairs in a single pass, encoding shared names once")
     parser.add_argument('--trust_remote_code', action="store_true",
                         help="allow for custom models defined in their own modeling files")
     parser.add_argument('--distance_threshold', type=str,
@@ -75,15 +97,28 @@ def init_logging():
     LOGGER.addHandler(console)
 
 
-def train(model, data_loader, scaler=None, amp=False):
-    train_loss = 0
-    train_steps = 0
+def train(model, data_loader, scaler=None, amp=False, progress=None, checkpoint_fn=None, checkpoint_step=None):
+    """
+    Train for one epoch (or what is left of it)
+
+    Parameters
+    ----------
+    progress : dict
+        Running totals of the epoch (loss, steps, step_time, num_tokens, global_step), updated in
+        place. Given when resuming in the middle of an epoch
+    checkpoint_fn : callable
+        Called with progress every checkpoint_step optimizer steps (counted across epochs)
+    """
+    if progress is None:
+        progress = {'train_loss': 0, 'train_steps': 0, 'step_time': 0, 'num_tokens': 0, 'global_step': 0}
     model.cuda()
     model.train()
     for i, data in tqdm(enumerate(data_loader), total=len(data_loader), desc="- Training Model"):
+        step_start = time.time()
         model.optimizer.zero_grad()
 
         batch_x1, batch_x2, batch_y = data
+        progress['num_tokens'] += int(batch_x1['attention_mask'].sum()) + int(batch_x2['attention_mask'].sum())
         batch_x_cuda1, batch_x_cuda2 = {}, {}
         for k, v in batch_x1.items():
             batch_x_cuda1[k] = v.cuda()
@@ -105,16 +140,27 @@ def train(model, data_loader, scaler=None, amp=False):
             loss.backward()
             model.optimizer.step()
 
-        train_loss += loss.item()
-        train_steps += 1
+        progress['train_loss'] += loss.item()  # also waits for the step to finish on the GPU
+        progress['train_steps'] += 1
+        progress['global_step'] += 1
+        progress['step_time'] += time.time() - step_start
 
-    train_loss /= (train_steps + 1e-9)
-    return train_loss
+        if checkpoint_fn is not None and progress['global_step'] % checkpoint_step == 0:
+            checkpoint_fn(progress)
+
+    train_loss = progress['train_loss'] / (progress['train_steps'] + 1e-9)
+    throughput = {
+        'step_time': progress['step_time'] / (progress['train_steps'] + 1e-9),
+        'tokens_per_sec': progress['num_tokens'] / (progress['step_time'] + 1e-9),
+    }
+    return train_loss, throughput
 
 
 def main(args):
     # logging and seed
     init_logging()
+    if args.resume and not args.checkpoint_dir:
+        raise ValueError("--resume needs the --checkpoint_dir to resume from")
     torch.manual_seed(args.random_seed)
 
     # load BERT tokenizer, dense_encoder
@@ -138,6 +184,9 @@ def main(args):
         miner_margin=args.miner_margin,
         type_of_triplets=args.type_of_triplets,
         agg_mode=args.agg_mode,
+        fused_forward=args.fused_forward,
+        pad_token_id=tokenizer.pad_token_id,
+        padding_side=tokenizer.padding_side,
     )
 
     # parallel training
@@ -163,14 +212,36 @@ def main(args):
         query_ids = torch.tensor(list(query_id))
         return query_encodings1, query_encodings2, query_ids
 
+    def collate_fn_token_store(batch):
+        # mean_all_tok pools over padding too, so it keeps the fixed max_length padding
+        length = args.max_length if args.agg_mode == "mean_all_tok" else None
+        name_ids1, name_ids2, query_id = zip(*batch)
+        query_encodings1 = model_wrapper.pad_batch([train_token_store[i] for i in name_ids1], length=length)
+        query_encodings2 = model_wrapper.pad_batch([train_token_store[i] for i in name_ids2], length=length)
+        query_ids = torch.tensor(list(query_id))
+        return query_encodings1, query_encodings2, query_ids
+
     # load data loader
-    train_set = MetricLearningDataset_pairwise(path=args.training_file_path, tokenizer=tokenizer)
+    if args.grouped:
+        train_set = MetricLearningDataset_grouped(
+            path=args.training_file_path, tokenizer=tokenizer, pairs_per_name=args.pairs_per_name, seed=args.random_seed
+        )
+    else:
+        train_set = MetricLearningDataset_pairwise(path=args.training_file_path, tokenizer=tokenizer)
+    if args.pretokenize:
+        train_token_store = TokenStore.load_or_build(args.training_file_path, tokenizer, args.max_length, train_set.names)
+        train_set.return_name_ids = True
+    # with checkpoints, the order of every epoch only depends on the seed, so a resumed run can skip
+    # the batches already trained on, and the loader draws its worker seeds from its own generator
+    train_sampler = ResumableRandomSampler(train_set, seed=args.random_seed) if args.checkpoint_dir else None
     training_data_loader = torch.utils.data.DataLoader(
         train_set,
         batch_size=args.train_batch_size,
-        shuffle=True,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
         num_workers=12,
-        collate_fn=collate_fn_batch_encoding
+        collate_fn=collate_fn_token_store if args.pretokenize else collate_fn_batch_encoding,
+        generator=torch.Generator() if args.checkpoint_dir else None
     )
 
     # load dictionary and data queries
@@ -178,6 +249,11 @@ def main(args):
         eval_dictionary_complete = DictionaryDataset(dictionary_path=args.complete_dictionary_path).data
         eval_dictionary_only_test_codes = DictionaryDataset(dictionary_path=args.only_test_codes_dictionary_path).data
         eval_queries = QueryDataset_custom(data_dir=args.validation_file_path, filter_duplicate=False).data
+        complete_dict_token_store = None
+        if args.pretokenize_dictionary:
+            complete_dict_token_store = TokenStore.load_or_build(
+                args.complete_dictionary_path, tokenizer, args.max_length, [row[0] for row in eval_dictionary_complete]
+            )
 
     # mixed precision training
     scaler = GradScaler() if args.amp else None
@@ -185,19 +261,82 @@ def main(args):
     # training loop
     start = time.time()
     current_best_model = {'accuracy': -1}
-    stats = {'accuracies': [], 'train_losses': [], 'val_losses': []}
-    for epoch in range(1, args.epoch + 1):
+    # checkpointed runs keep the best weights on disk, instead of copying them into every checkpoint
+    best_model_snapshot_dir = args.best_model_snapshot_dir
+    if best_model_snapshot_dir is None and args.checkpoint_dir:
+        best_model_snapshot_dir = os.path.join(args.checkpoint_dir, "best_model")
+    best_model_snapshot = ModelSnapshot(best_model_snapshot_dir)
+    stats = {'accuracies': [], 'train_losses': [], 'val_losses': [], 'throughput': []}
+
+    # checkpoints
+    checkpointer = TrainingCheckpointer(args.checkpoint_dir, keep_all=args.save_checkpoint_all) if args.checkpoint_dir else None
+    start_epoch, global_step, progress, elapsed = 1, 0, None, 0
+
+    def save_checkpoint(epoch, global_step, progress=None):
+        # progress is None once the epoch is over (and evaluated)
+        checkpointer.save({
+            'encoder': model_wrapper.encoder.state_dict(),
+            'optimizer': model.optimizer.state_dict(),
+            'scaler': scaler.state_dict() if scaler is not None else None,
+            'best_model_snapshot': best_model_snapshot.state_dict(),
+            'current_best_model': current_best_model,
+            'stats': stats,
+            'elapsed': elapsed + time.time() - start,
+            'epoch': epoch,
+            'global_step': global_step,
+            'progress': progress,
+            'rng_state': get_rng_state(),
+        }, global_step)
+
+    if args.resume:
+        checkpoint_path = checkpointer.latest()
+        if checkpoint_path is None:
+            LOGGER.info("No checkpoint in {}, training from scratch".format(args.checkpoint_dir))
+        else:
+            checkpoint = checkpointer.load(checkpoint_path)
+            model_wrapper.encoder.load_state_dict(checkpoint['encoder'])
+            model_wrapper.invalidate()
+            model.optimizer.load_state_dict(checkpoint['optimizer'])
+            if scaler is not None and checkpoint['scaler'] is not None:
+                scaler.load_state_dict(checkpoint['scaler'])
+            best_model_snapshot.load_state_dict(checkpoint['best_model_snapshot'])
+            current_best_model = checkpoint['current_best_model']
+            stats = checkpoint['stats']
+            elapsed = checkpoint['elapsed']
+            global_step = checkpoint['global_step']
+            progress = checkpoint['progress']
+            start_epoch = checkpoint['epoch'] + (1 if progress is None else 0)
+            set_rng_state(checkpoint['rng_state'])
+            LOGGER.info("Resuming from epoch {} after {} steps".format(start_epoch, global_step))
+            del checkpoint
+
+    for epoch in range(start_epoch, args.epoch + 1):
         LOGGER.info("Epoch {}/{}".format(epoch, args.epoch))
 
         LOGGER.info("Training")
-        train_loss = train(
+        if args.grouped:
+            train_set.set_epoch(epoch)
+        if progress is None:
+            progress = {'train_loss': 0, 'train_steps': 0, 'step_time': 0, 'num_tokens': 0, 'global_step': global_step}
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch, start=progress['train_steps'] * args.train_batch_size)
+        train_loss, throughput = train(
             model=model,
             data_loader=training_data_loader,
             scaler=scaler,
-            amp=True if args.amp else False
+            amp=True if args.amp else False,
+            progress=progress,
+            checkpoint_fn=(lambda progress: save_checkpoint(epoch, progress['global_step'], progress)) if checkpointer else None,
+            checkpoint_step=args.checkpoint_step
         )
+        global_step = progress['global_step']
+        progress = None
+        model_wrapper.invalidate()
         LOGGER.info(f'Training Loss: {train_loss}')
+        LOGGER.info(f"Step time: {throughput['step_time']:.4f}s, tokens/sec: {throughput['tokens_per_sec']:.0f} "
+                    f"({'fused' if args.fused_forward else 'two-pass'} forward)")
         stats['train_losses'].append(train_loss)
+        stats['throughput'].append(throughput)
 
         if args.validation_file_path:
             LOGGER.info("Evaluating")
@@ -206,7 +345,8 @@ def main(args):
                 eval_dictionary_complete=eval_dictionary_complete,
                 eval_dictionary_only_test_codes=eval_dictionary_only_test_codes,
                 eval_queries=eval_queries,
-                agg_mode=args.agg_mode
+                agg_mode=args.agg_mode,
+                complete_dict_token_store=complete_dict_token_store
             )
             LOGGER.info(f"Accuracy: {accuracy_evalset}")
             stats['accuracies'].append(accuracy_evalset)
@@ -216,22 +356,24 @@ def main(args):
 
             if accuracy_evalset > current_best_model['accuracy']:
                 LOGGER.info("Saving Best Model")
-                del current_best_model
                 current_best_model = {
-                    'model': copy.deepcopy(model_wrapper),
                     'accuracy': accuracy_evalset,
                     'epoch': epoch,
                 }
+                best_model_snapshot.take(model_wrapper.encoder, **current_best_model)
         else:
             if epoch == args.epoch:
+                # the model after the last epoch is the current one, so there is nothing to snapshot
                 current_best_model = {
-                    'model': copy.deepcopy(model_wrapper),
                     'epoch': epoch,
                 }
 
+        if checkpointer is not None:
+            save_checkpoint(epoch, global_step)
+
     # log training and validation time
     end = time.time()
-    training_time = end - start
+    training_time = elapsed + end - start
     training_hour = int(training_time / 60 / 60)
     training_minute = int(training_time / 60 % 60)
     training_second = int(training_time % 60)
@@ -240,12 +382,15 @@ def main(args):
     os.makedirs(os.path.dirname(args.results_file_path), exist_ok=True)
 
     # saving best model
+    best_model_snapshot.wait()
     if args.output_dir_for_best_model:
         best_model_path = args.output_dir_for_best_model.replace("EPOCH", str(current_best_model['epoch']))
         if not os.path.exists(best_model_path):
             os.makedirs(best_model_path)
-        current_best_model['model'].save_model(best_model_path)
-        # model_wrapper.save_model(best_model_path)
+        if best_model_snapshot.info is not None and current_best_model['epoch'] != args.epoch:
+            best_model_snapshot.restore(model_wrapper.encoder)
+            model_wrapper.invalidate()
+        model_wrapper.save_model(best_model_path)
 
     # saving stats
     if args.validation_file_path:
@@ -26,6 +26,8 @@ def parse_args():
                         help='Use own Word2Vec models instead of the default FastText ones')
     parser.add_argument('--distance_threshold', type=float, required=False, default=0.7,
                         help='The max distance from a query entity to a synonym')
+    parser.add_argument('--grouped', action="store_true",
+                        help='Write a code-grouped training file (one code||entity line per synonym) instead of every pair')
     args = parser.parse_args()
     return args
 
@@ -34,19 +36,24 @@ def load_data(file_path):
     codes_and_entities = {}
     with open(file_path, 'r', encoding='utf-8') as f:
         for line in f:
-            code, entity1, entity2 = line.strip().split('||')
+            # pairwise (code||entity1||entity2) or code-grouped (code||entity) lines
+            code, *entities = line.strip().split('||')
             if code in codes_and_entities:
-                codes_and_entities[code].extend([entity1, entity2])
+                codes_and_entities[code].extend(entities)
             else:
-                codes_and_entities[code] = [entity1, entity2]
+                codes_and_entities[code] = entities
         for code, entities in codes_and_entities.items():
             codes_and_entities[code] = remove_duplicates_and_preserve_order(entities)
     return codes_and_entities
 
 
-def save_data(augmented_data, new_entities_aux, augmented_data_file_path, new_entities_aux_file_path=None):
+def save_data(augmented_data, new_entities_aux, augmented_data_file_path, new_entities_aux_file_path=None, grouped=False):
     with open(augmented_data_file_path, 'w', encoding='utf-8') as f:
         for code, entities in augmented_data.items():
+            if grouped:
+                for entity in entities:
+                    f.write(f"{code}||{entity}\n")
+                continue
             for i, entity_a in enumerate(entities):
                 for entity_b in entities[i + 1:]:
                     f.write(f"{code}||{entity_a}||{entity_b}\n")
@@ -132,14 +139,14 @@ def main():
         f'../../fasttext-models/cc.{args.lang}.300.vec.gz', binary=False)
     input_file_path = f"../../../el/sapbert/symptemist-parse/out/final-model/{args.lang}/sapbert_symptemist_{args.lang}_training_file.txt"
     output_dir = 'out/word2vec' if args.word2vec else 'out/fasttext'
-    output_file_path = f"{output_dir}/{args.lang}/sapbert_symptemist_{args.lang}_training_file_aug_{args.augment_factor}_{args.distance_threshold}.txt"
+    output_file_path = f"{output_dir}/{args.lang}/sapbert_symptemist_{args.lang}_training_file_aug_{args.augment_factor}_{args.distance_threshold}{'_grouped' if args.grouped else ''}.txt"
     aux_file_path = f"{output_dir}/{args.lang}/aux/new_entities_{args.lang}_{args.augment_factor}_{args.distance_threshold}.txt"
     log_file_path = f"{output_dir}/{args.lang}/aux/log.txt"
     os.makedirs(os.path.dirname(aux_file_path), exist_ok=True)
 
     original_data = load_data(input_file_path)
     augmented_data, new_entities_aux = augment_data(args, model, original_data, args.augment_factor, args.distance_threshold)
-    save_data(augmented_data, new_entities_aux, output_file_path, aux_file_path)
+    save_data(augmented_data, new_entities_aux, output_file_path, aux_file_path, args.grouped)
 
     log = f"Language: {args.lang}\nDistance Threshold: {args.distance_threshold}\nOriginal data size: {get_file_size(input_file_path)}\nAugmented data size: {get_file_size(output_file_path)}\n\n"
     with open(log_file_path, "a+") as f:
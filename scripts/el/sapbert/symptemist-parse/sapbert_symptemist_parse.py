@@ -1,6 +1,7 @@
 import os
 import json
 import random
+import argparse
 import pandas as pd
 
 
@@ -22,7 +23,7 @@ paths_per_language = {
 }
 
 
-def build_training_file(training_file_path, output_dir, lang, mode):
+def build_training_file(training_file_path, output_dir, lang, mode, grouped=False):
     # If mode = hyperparameter-search, split 80% of the training data for the training file, and 20% for the validation
     # file. (this function only builds the training file tho). Else, use all the training data for the training file
     with open(training_file_path, 'r') as f:
@@ -50,15 +51,25 @@ def build_training_file(training_file_path, output_dir, lang, mode):
         else:
             training_codes_and_entities_json[code] = {entity}
 
-    # Write training file
-    with open(f"{output_dir}/sapbert_symptemist_{lang}_training_file.txt", 'w') as f:
-        for code, entities_set in training_codes_and_entities_json.items():
-            if code == 'NO_CODE':
-                continue
-            entities = list(entities_set)
-            for i, entity_a in enumerate(entities):
-                for entity_b in entities[i + 1:]:
-                    f.write(f"{code}||{entity_a}||{entity_b}\n")
+    # Write training file: every pair of synonyms, or (grouped) one line per synonym, as positive pairs
+    # are then sampled at training time and the file grows with the number of names instead of pairs.
+    # Grouped entities are sorted, as the iteration order of a set changes across runs
+    if grouped:
+        with open(f"{output_dir}/sapbert_symptemist_{lang}_training_file_grouped.txt", 'w') as f:
+            for code, entities_set in training_codes_and_entities_json.items():
+                if code == 'NO_CODE':
+                    continue
+                for entity in sorted(entities_set):
+                    f.write(f"{code}||{entity}\n")
+    else:
+        with open(f"{output_dir}/sapbert_symptemist_{lang}_training_file.txt", 'w') as f:
+            for code, entities_set in training_codes_and_entities_json.items():
+                if code == 'NO_CODE':
+                    continue
+                entities = list(entities_set)
+                for i, entity_a in enumerate(entities):
+                    for entity_b in entities[i + 1:]:
+                        f.write(f"{code}||{entity_a}||{entity_b}\n")
 
     # Write an auxiliary file with the training data in the gazetteer
     # format, that will be appended to the final dictionary file
@@ -182,9 +193,14 @@ def build_el_test_file_reference_tsv(paths):
     return df
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--grouped', action="store_true",
+                    help='Write a code-grouped training file (one code||entity line per synonym) instead of every pair')
+args = parser.parse_args()
+
 for lang, paths in paths_per_language.items():
     os.makedirs(os.path.join(paths['output_dir'], 'aux'), exist_ok=True)
-    build_training_file(paths['training_file_path'], paths['output_dir'], lang, mode)
+    build_training_file(paths['training_file_path'], paths['output_dir'], lang, mode, args.grouped)
     if mode == "hyperparameter-search":
         codes = build_test_file(paths['training_file_path'], paths['output_dir'], lang, mode)
     else: